@@ -0,0 +1,250 @@
+#!/usr/bin/python
+"""
+Replays terminal output through webterm's frame pipeline and reports what
+each stage costs, with no pty, no network and no browser in the way.
+
+Each chunk of a stream is fed to a TerminalSession's screen as if it were one
+read from the pty, and the frame it makes goes through the change table and
+is packed in every encoding, just as it would be for a client. Run it before
+and after a change with --save and --baseline to see what the change did.
+"""
+
+import argparse
+import json
+import random
+import time
+
+from webterm.termsess import TerminalSession
+from webterm.app import AppState
+from webterm.messages import (ChangeMessage, Prepacked, Deflater,
+    pack_response, envelopes, compressed)
+from webterm import config
+
+STAGES = ["feed", "encode", "table", "pack"]
+
+def esc(s):
+    return "\x1b[" + s
+
+def vim_scroll(rows, cols, steps = 2000):
+    """
+    vim scrolling through a long file a line at a time, as when j is held
+    down: the text scrolls within a region and the ruler is redrawn.
+    """
+    words = ["def", "return", "self", "import", "for", "in", "if", "else",
+        "lambda", "None", "(i)", "[0]", "=", "+", "\"string\""]
+    colours = ["33", "36", "35", "32", "0"]
+    rng = random.Random(1)
+    def source_line(n):
+        out = [esc("34m") + "%4d " % n + esc("0m")]
+        width = 5
+        while width < cols - 12:
+            word = rng.choice(words)
+            out.append(esc(rng.choice(colours) + "m") + word + " ")
+            width += len(word) + 1
+        return "".join(out) + esc("0m")
+    yield esc("H") + esc("2J") + "\r\n".join(
+        source_line(i) for i in range(1, rows))
+    yield esc("1;%dr" % (rows - 1))
+    for n in range(rows, rows + steps):
+        yield (esc("%d;1H" % (rows - 1)) + "\n" + source_line(n)
+            + esc("%d;1H" % rows) + esc("K")
+            + "%d,1%s%d%%" % (n, " " * (cols - 24), n * 100 // (rows + steps))
+            + esc("%d;6H" % (rows - 1)))
+
+def roguelike(rows, cols, turns = 600):
+    """
+    A roguelike: a full coloured redraw every so often and, in between,
+    monsters stepping about and the status line changing.
+    """
+    rng = random.Random(2)
+    tiles = [(".", "37"), ("#", "33"), ("~", "34"), ("\"", "32")]
+    monsters = [[rng.randrange(1, cols - 1), rng.randrange(2, rows - 2)]
+        for i in range(20)]
+    def redraw():
+        out = [esc("H"), esc("2J")]
+        for y in range(1, rows - 1):
+            out.append(esc("%d;1H" % (y + 1)))
+            for x in range(cols):
+                glyph, colour = rng.choice(tiles)
+                out.append(esc("1;%sm" % colour) + glyph)
+        return "".join(out) + esc("0m")
+    for turn in range(turns):
+        if turn % 50 == 0:
+            yield redraw()
+        out = []
+        for m in monsters:
+            out.append(esc("%d;%dH" % (m[1] + 1, m[0] + 1)) + esc("37m") + ".")
+            m[0] = min(cols - 1, max(0, m[0] + rng.choice((-1, 0, 1))))
+            m[1] = min(rows - 2, max(1, m[1] + rng.choice((-1, 0, 1))))
+            out.append(esc("%d;%dH" % (m[1] + 1, m[0] + 1)) + esc("1;31m")
+                + rng.choice("kogDZ"))
+        out.append(esc("%d;1H" % rows) + esc("0m") + esc("K")
+            + "HP:%d(30) Pw:7(7) AC:4 T:%d" % (rng.randrange(1, 31), turn))
+        yield "".join(out)
+
+def cat_file(rows, cols, size = 1 << 20, chunk = 4096):
+    """
+    cat of a large text file, arriving in pty-sized reads.
+    """
+    rng = random.Random(3)
+    lines = []
+    total = 0
+    while total < size:
+        line = "%08d %s\r\n" % (len(lines), "".join(
+            rng.choice("abcdefghijklmnopqrstuvwxyz    ")
+            for i in range(rng.randrange(0, cols - 8))))
+        lines.append(line)
+        total += len(line)
+    data = "".join(lines)
+    for i in xrange(0, len(data), chunk):
+        yield data[i:i + chunk]
+
+def recorded(path, chunk = 4096):
+    """
+    Raw pty output recorded to a file, e.g. by script(1).
+    """
+    with open(path, "rb") as f:
+        while True:
+            s = f.read(chunk)
+            if not s:
+                return
+            yield s
+
+streams = {
+    "vim-scroll"    : vim_scroll,
+    "roguelike"     : roguelike,
+    "cat"           : cat_file,
+}
+
+class PackingSubscriber(object):
+    """
+    Stands in for a namespace: packs every frame in every encoding, the way
+    one is packed for a set of clients, and times it. Compressed encodings
+    are compressed as for one client that gets every frame.
+    """
+    def __init__(self, state):
+        self.state = state
+        self.elapsed = 0
+        self.sizes = dict((i, 0) for i in envelopes)
+        self.deflater = Deflater()
+    def frame(self, changes, cursor):
+        started = time.time()
+        message = Prepacked(ChangeMessage(changes, cursor))
+        for i in envelopes:
+            data = pack_response(message, i)
+            if i in compressed:
+                data = self.deflater.deflate(data)
+            self.sizes[i] += len(self.state.namespace.encode_frame(data))
+        self.elapsed += time.time() - started
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def run(chunks, rows, cols):
+    """
+    Feeds every chunk through the pipeline and returns the results.
+    """
+    state = AppState("bench", "/bench", "bench", [], ".")
+    subscriber = PackingSubscriber(state)
+    state.subscribers = [subscriber]
+    timings = dict((i, []) for i in STAGES)
+    frame = {}
+
+    def add_frame(lines, cursor):
+        started = time.time()
+        packing = subscriber.elapsed
+        state.add_frame(lines, cursor)
+        frame["table"] = time.time() - started - (subscriber.elapsed - packing)
+        frame["pack"] = subscriber.elapsed - packing
+        frame["callback"] = time.time() - started
+
+    session = TerminalSession("bench", [], ".", rows = rows, cols = cols)
+    session.open_screen(add_frame)
+    session.compose_frame()
+
+    chunks = list(chunks) # so that making them isn't timed
+    frames = 0
+    read = 0
+    started = time.time()
+    for chunk in chunks:
+        frame.clear()
+        read += len(chunk)
+        t0 = time.time()
+        session.stream.feed(chunk)
+        t1 = time.time()
+        session.compose_frame()
+        t2 = time.time()
+        timings["feed"].append(t1 - t0)
+        if not frame:
+            continue
+        frames += 1
+        timings["encode"].append(t2 - t1 - frame["callback"])
+        timings["table"].append(frame["table"])
+        timings["pack"].append(frame["pack"])
+    elapsed = time.time() - started
+
+    result = {
+        "frames"        : frames,
+        "read_bytes"    : read,
+        "seconds"       : elapsed,
+        "fps"           : frames / elapsed if elapsed else 0.0,
+        "bytes_per_frame": dict((i, n / float(frames or 1))
+            for i, n in subscriber.sizes.iteritems()),
+    }
+    for stage, samples in timings.iteritems():
+        samples.sort()
+        result[stage] = {
+            "p50"   : percentile(samples, 0.5),
+            "p99"   : percentile(samples, 0.99),
+            "total" : sum(samples),
+        }
+    return result
+
+def report(name, result, baseline = None):
+    def change(new, old):
+        if not old:
+            return ""
+        return " (%+.0f%%)" % ((new - old) * 100.0 / old)
+    old = baseline or {}
+    print "== %s: %d frames from %d bytes in %.2fs" % (name,
+        result["frames"], result["read_bytes"], result["seconds"])
+    print "   %.0f frames/s%s" % (result["fps"],
+        change(result["fps"], old.get("fps")))
+    for encoding, size in sorted(result["bytes_per_frame"].iteritems()):
+        print "   %.0f bytes/frame as %s%s" % (size, encoding,
+            change(size, old.get("bytes_per_frame", {}).get(encoding)))
+    print "   %-8s %10s %10s %10s" % ("stage", "p50 us", "p99 us", "total s")
+    for stage in STAGES:
+        s = result[stage]
+        o = old.get(stage, {})
+        print "   %-8s %10.1f %10.1f %10.3f%s" % (stage, s["p50"] * 1e6,
+            s["p99"] * 1e6, s["total"], change(s["total"], o.get("total")))
+
+def main(names, files, rows, cols, save, baseline):
+    baseline = json.load(open(baseline)) if baseline else {}
+    results = {}
+    for name in names:
+        results[name] = run(streams[name](rows, cols), rows, cols)
+        report(name, results[name], baseline.get(name))
+    for path in files:
+        results[path] = run(recorded(path), rows, cols)
+        report(path, results[path], baseline.get(path))
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent = 4)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("bench", description = 'replays terminal output through the frame pipeline',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s'    , '--stream'    , action='append', choices=sorted(streams), help="built-in stream to replay (default: all of them)")
+    parser.add_argument('-f'    , '--file'      , action='append', default=[], help="file of recorded pty output to replay")
+    parser.add_argument('-r'    , '--rows'      , type=int, default=config.ROWS         , help="screen rows")
+    parser.add_argument('-c'    , '--cols'      , type=int, default=config.COLS         , help="screen columns")
+    parser.add_argument('--save'                , type=str, default=None                , help="write the results to this file as JSON")
+    parser.add_argument('--baseline'            , type=str, default=None                , help="compare against results saved earlier")
+
+    g = parser.parse_args()
+    names = g.stream or ([] if g.file else sorted(streams))
+    main(names, g.file, g.rows, g.cols, g.save, g.baseline)
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+"""
+Measures keystroke-to-screen latency as more and more clients watch.
+
+Starts a webterm running a small echo program, connects one arbiter and then
+spectators until there are N clients in all, for each N asked for. The arbiter
+types keys one at a time; each key's time is measured from sending it to its
+echo reaching each client, and the server's CPU use and memory are read from
+/proc while it happens.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent
+import gevent.event
+import gevent.queue
+
+from webterm.client import ApiClient
+from webterm.chat import ADMIN_PASS
+from webterm import messages
+
+# Reads keys raw and answers each with a numbered line, a different line each
+# time, so every key makes exactly one change.
+ECHO_PROGRAM = r"""
+import os, tty
+tty.setraw(0)
+n = 0
+while True:
+    key = os.read(0, 1)
+    if not key:
+        break
+    n += 1
+    os.write(1, "\x1b[%d;1H%08d %r\x1b[K" % (n % 20 + 1, n, key))
+"""
+
+def write_echo_program(directory):
+    path = os.path.join(directory, "echo.py")
+    with open(path, "w") as f:
+        f.write("#!%s\n%s" % (sys.executable, ECHO_PROGRAM))
+    os.chmod(path, 0755)
+    return path
+
+def start_server(port, directory):
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen([sys.executable, "main.py", "-i", "127.0.0.1",
+        "-p", str(port), "-c", write_echo_program(directory),
+        "-w", directory], cwd = here, stdout = open(os.devnull, "w"),
+        stderr = subprocess.STDOUT)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit("the server didn't start")
+
+class ProcessStats(object):
+    """
+    CPU time and resident memory of a process, from /proc.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+    def cpu(self):
+        with open("/proc/%d/stat" % self.pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        # utime and stime, the 14th and 15th fields counting pid and comm
+        return (int(fields[11]) + int(fields[12])) / float(
+            os.sysconf("SC_CLK_TCK"))
+    def rss(self):
+        with open("/proc/%d/status" % self.pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+class Viewer(object):
+    """
+    One client, noting when each screen update reaches it.
+    """
+    def __init__(self, host, port, endpoint):
+        self.api = ApiClient(host, port, endpoint)
+        self.updates = gevent.queue.Queue()
+        self.owner = gevent.event.Event()
+    def connect(self):
+        self.api.connect()
+        self.api.request("s", {"encodings": ["json"]})
+        self.api.request("h", {})
+        self.api.request("%")
+        gevent.spawn(self.listen)
+    def listen(self):
+        while True:
+            message = self.api.receive()
+            if message is None:
+                return
+            id_, response = message
+            if response[0] in ("?", "%") and id_ is None:
+                self.updates.put(time.time())
+            elif response == ["~", messages.YOU]:
+                self.owner.set()
+    def drain(self):
+        while not self.updates.empty():
+            self.updates.get_nowait()
+    def take_control(self):
+        self.api.request(":", "/auth admin %s" % ADMIN_PASS)
+        self.api.request(":", "/ask")
+        if not self.owner.wait(10):
+            raise SystemExit("couldn't become arbiter")
+
+def percentile(samples, fraction):
+    if not samples:
+        return float("nan")
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def measure(arbiter, viewers, keys, timeout):
+    """
+    Types keys one at a time and returns the latencies seen by the arbiter
+    and by everyone else, and how many echoes never arrived.
+    """
+    own, others = [], []
+    lost = 0
+    for i in range(keys):
+        for v in viewers:
+            v.drain()
+        sent = time.time()
+        arbiter.api.notify("i", [ord("a") + i % 26])
+        for v in viewers:
+            try:
+                arrived = v.updates.get(timeout = timeout)
+            except gevent.queue.Empty:
+                lost += 1
+                continue
+            (own if v is arbiter else others).append(arrived - sent)
+        gevent.sleep(0.01) # let stragglers settle before the next key
+    return sorted(own), sorted(others), lost
+
+def report_header():
+    print "%6s %9s %9s %9s %9s %9s %9s %6s %7s %8s" % ("N",
+        "own p50", "own p99", "p50", "p90", "p99", "max", "lost",
+        "cpu %", "rss MB")
+
+def report(n, own, others, lost, cpu, rss):
+    ms = lambda s: "%9.1f" % (s * 1000)
+    everyone = sorted(own + others)
+    print "%6d %s %s %s %s %s %s %6d %7s %8s" % (n,
+        ms(percentile(own, 0.5)), ms(percentile(own, 0.99)),
+        ms(percentile(everyone, 0.5)), ms(percentile(everyone, 0.9)),
+        ms(percentile(everyone, 0.99)),
+        ms(everyone[-1] if everyone else float("nan")), lost,
+        "%.0f" % cpu if cpu is not None else "-",
+        "%.1f" % (rss / 1048576.0) if rss is not None else "-")
+    sys.stdout.flush()
+
+def main(counts, keys, host, port, endpoint, pid, timeout):
+    server = None
+    if not host:
+        host = "127.0.0.1"
+        server = start_server(port, tempfile.mkdtemp(prefix = "webterm-load"))
+        pid = server.pid
+    stats = ProcessStats(pid) if pid else None
+    try:
+        arbiter = Viewer(host, port, endpoint)
+        arbiter.connect()
+        arbiter.take_control()
+        viewers = [arbiter]
+        report_header()
+        for n in counts:
+            while len(viewers) < n:
+                v = Viewer(host, port, endpoint)
+                v.connect()
+                viewers.append(v)
+            gevent.sleep(1) # let the joins and their screens go out
+            cpu_before = stats.cpu() if stats else None
+            started = time.time()
+            own, others, lost = measure(arbiter, viewers, keys, timeout)
+            cpu = ((stats.cpu() - cpu_before) * 100 / (time.time() - started)
+                if stats else None)
+            report(n, own, others, lost, cpu, stats.rss() if stats else None)
+    finally:
+        if server:
+            server.kill()
+            server.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("loadtest", description = 'measures keystroke-to-screen latency against a webterm',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n'    , '--clients'   , type=str, default="1,5,10,25,50"      , help="comma-separated numbers of clients to measure with, arbiter included")
+    parser.add_argument('-k'    , '--keys'      , type=int, default=100                 , help="keys to type for each number of clients")
+    parser.add_argument('-p'    , '--port'      , type=int, default=5099                , help="port to start the server on, or of the server given with --host")
+    parser.add_argument('--host'                , type=str, default=None                , help="test a server that is already running here instead of starting one")
+    parser.add_argument('--pid'                 , type=int, default=None                , help="process id of that server, for CPU and memory figures")
+    parser.add_argument('-e'    , '--endpoint'  , type=str, default="/api"              , help="endpoint of the terminal to test")
+    parser.add_argument('-t'    , '--timeout'   , type=float, default=5.0               , help="seconds to wait for an echo before counting it lost")
+
+    g = parser.parse_args()
+    main([int(i) for i in g.clients.split(",")], g.keys, g.host, g.port,
+        g.endpoint, g.pid, g.timeout)
@@ -1,15 +1,58 @@
 #!/usr/bin/python
 
+import os
+import random
+import socket
 import argparse
+import tempfile
 import webterm.config as config
-from socketio.server import SocketIOServer
 
-def main(ip, port, cmd):
+def main(ip, port, cmd, working_dir, relay, relay_auth, workers):
     # this is a bit of a hack
     config.COMMAND = cmd
+    config.WORKING_DIR = working_dir
+    config.RELAY = relay
+    config.RELAY_AUTH = relay_auth
 
+    if workers:
+        serve_workers(ip, port, workers)
+        return
     from webterm.app import app
-    SocketIOServer((ip, port), app, resource='socket.io').serve_forever()
+    from webterm.server import WebtermServer
+    WebtermServer((ip, port), app, resource='socket.io').serve_forever()
+
+def serve_workers(ip, port, workers):
+    """
+    Runs the terminals in this process, the hub, and forks that many workers
+    to serve clients from the port between them.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((ip, port))
+    listener.listen(1024)
+    listener.setblocking(0)
+    hub_listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    config.HUB_SOCKET = os.path.join(tempfile.mkdtemp(prefix = "webterm"),
+        "hub")
+    hub_listener.bind(config.HUB_SOCKET)
+    hub_listener.listen(workers)
+    hub_listener.setblocking(0)
+
+    for i in range(workers):
+        if os.fork() == 0:
+            random.seed() # or every worker would draw the same numbers
+            hub_listener.close()
+            config.FRONTEND_ROLE = "worker"
+            from webterm.frontend import FrontendServer
+            from webterm.app import app
+            FrontendServer(listener, app, resource='socket.io',
+                policy_server=False).serve_forever()
+            os._exit(0)
+    listener.close()
+    config.FRONTEND_ROLE = "hub"
+    from webterm.frontend import serve_hub
+    from webterm.app import registry
+    serve_hub(hub_listener, registry)
 
 if __name__ == "__main__":
     import sys
@@ -18,9 +61,13 @@ if __name__ == "__main__":
     parser.add_argument('-p'    , '--port'      , type=int, default=config.PORT         , help="port to run server on")
     parser.add_argument('-i'    , '--ip'        , type=str, default="0.0.0.0"           , help="IP to listen on")
     parser.add_argument('-c'    , '--command'   , type=str, default=config.COMMAND      , help="command to run")
+    parser.add_argument('-w'    , '--working-dir', type=str, default=config.WORKING_DIR , help="directory to run the command in")
+    parser.add_argument('-r'    , '--relay'     , type=str, default=config.RELAY        , help="relay the terminal at this url, like http://origin:5000/api, instead of running a command")
+    parser.add_argument('--relay-auth'          , type=str, default=config.RELAY_AUTH   , help="'username password' to take control upstream with for our arbiter")
+    parser.add_argument('-n'    , '--workers'   , type=int, default=config.FRONTEND_WORKERS, help="serve clients from this many processes, with the terminals in one more")
 
     g = parser.parse_args()
     ip = g.ip
     port = g.port
     command = g.command
-    main(ip, port, command)
+    main(ip, port, command, g.working_dir, g.relay, g.relay_auth, g.workers)
@@ -4,7 +4,7 @@ except ImportError:
     print "setuptools not found: using distutils"
     from distutils.core import setup
 
-reqs = ["gevent", "flask", "gevent_socketio", "pyte"]
+reqs = ["gevent", "flask", "gevent_socketio", "pyte", "msgpack-python"]
 setup(
     name = "Webterm",
     version = "pretty old",
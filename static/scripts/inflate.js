@@ -0,0 +1,194 @@
+inflate = {
+    // Just enough raw deflate (RFC 1951) to read the deflate encoding.
+    // Works on binary strings (one char per byte), as produced by atob.
+    // A stream keeps the last 32K bytes it inflated, starting with the
+    // preset dictionary, since every message may refer back into them.
+    windowSize: 32768,
+    stream: function(dictionary) {
+        var stream = {
+            window  : new Uint8Array(inflate.windowSize),
+            pos     : 0
+        };
+        for (var i = 0; i < dictionary.length; i++) {
+            inflate.put(stream, dictionary.charCodeAt(i) & 0xff);
+        }
+        return stream;
+    },
+    put: function(stream, b) {
+        stream.window[stream.pos++ & (inflate.windowSize - 1)] = b;
+    },
+    decode: function(stream, bytes) {
+        // Inflates one message, putting back the end of the sync flush the
+        // server leaves out, and returns it as a binary string.
+        var reader = {
+            bytes   : bytes + "\x00\x00\xff\xff",
+            pos     : 0,
+            bits    : 0,
+            count   : 0,
+            out     : []
+        };
+        while (reader.pos < reader.bytes.length) {
+            inflate.bits(reader, 1); // last block: never, the stream goes on
+            var type = inflate.bits(reader, 2);
+            if (type == 0) {
+                inflate.stored(stream, reader);
+            } else if (type == 1) {
+                inflate.codes(stream, reader, inflate.fixed.lengths,
+                    inflate.fixed.distances);
+            } else if (type == 2) {
+                var tables = inflate.dynamic(reader);
+                inflate.codes(stream, reader, tables[0], tables[1]);
+            } else {
+                throw "inflate: bad block type";
+            }
+        }
+        var out = "";
+        for (var i = 0; i < reader.out.length; i += 4096) {
+            out += String.fromCharCode.apply(null,
+                reader.out.slice(i, i + 4096));
+        }
+        return out;
+    },
+    bits: function(reader, n) {
+        while (reader.count < n) {
+            reader.bits |= (reader.bytes.charCodeAt(reader.pos++) & 0xff)
+                << reader.count;
+            reader.count += 8;
+        }
+        var out = reader.bits & ((1 << n) - 1);
+        reader.bits >>>= n;
+        reader.count -= n;
+        return out;
+    },
+    emit: function(stream, reader, b) {
+        inflate.put(stream, b);
+        reader.out.push(b);
+    },
+    stored: function(stream, reader) {
+        reader.bits = 0; // skip to the byte boundary
+        reader.count = 0;
+        var length = inflate.bits(reader, 16);
+        inflate.bits(reader, 16); // its complement
+        for (var i = 0; i < length; i++) {
+            inflate.emit(stream, reader,
+                reader.bytes.charCodeAt(reader.pos++) & 0xff);
+        }
+    },
+    table: function(lengths) {
+        // A canonical Huffman code as the number of codes of each length
+        // and the symbols in code order.
+        var counts = new Uint16Array(16);
+        var offsets = new Uint16Array(16);
+        var symbols = new Uint16Array(lengths.length);
+        for (var i = 0; i < lengths.length; i++) {
+            counts[lengths[i]]++;
+        }
+        counts[0] = 0;
+        for (var i = 1; i < 16; i++) {
+            offsets[i] = offsets[i - 1] + counts[i - 1];
+        }
+        for (var i = 0; i < lengths.length; i++) {
+            if (lengths[i]) {
+                symbols[offsets[lengths[i]]++] = i;
+            }
+        }
+        return {counts: counts, symbols: symbols};
+    },
+    symbol: function(reader, table) {
+        var code = 0, first = 0, index = 0;
+        for (var length = 1; length < 16; length++) {
+            code |= inflate.bits(reader, 1);
+            var count = table.counts[length];
+            if (code - first < count) {
+                return table.symbols[index + code - first];
+            }
+            index += count;
+            first = (first + count) << 1;
+            code <<= 1;
+        }
+        throw "inflate: bad code";
+    },
+    lengthBase: [3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31, 35,
+        43, 51, 59, 67, 83, 99, 115, 131, 163, 195, 227, 258],
+    lengthExtra: [0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3,
+        4, 4, 4, 4, 5, 5, 5, 5, 0],
+    distanceBase: [1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193,
+        257, 385, 513, 769, 1025, 1537, 2049, 3073, 4097, 6145, 8193, 12289,
+        16385, 24577],
+    distanceExtra: [0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8,
+        8, 9, 9, 10, 10, 11, 11, 12, 12, 13, 13],
+    codeLengthOrder: [16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2,
+        14, 1, 15],
+    codes: function(stream, reader, lengths, distances) {
+        var mask = inflate.windowSize - 1;
+        while (true) {
+            var symbol = inflate.symbol(reader, lengths);
+            if (symbol < 256) {
+                inflate.emit(stream, reader, symbol);
+                continue;
+            }
+            if (symbol == 256) {
+                return;
+            }
+            symbol -= 257;
+            var length = inflate.lengthBase[symbol]
+                + inflate.bits(reader, inflate.lengthExtra[symbol]);
+            var code = inflate.symbol(reader, distances);
+            var distance = inflate.distanceBase[code]
+                + inflate.bits(reader, inflate.distanceExtra[code]);
+            for (var i = 0; i < length; i++) {
+                inflate.emit(stream, reader,
+                    stream.window[(stream.pos - distance) & mask]);
+            }
+        }
+    },
+    dynamic: function(reader) {
+        var literals = inflate.bits(reader, 5) + 257;
+        var distances = inflate.bits(reader, 5) + 1;
+        var codeLengths = inflate.bits(reader, 4) + 4;
+        var lengths = new Array(19);
+        for (var i = 0; i < 19; i++) {
+            lengths[i] = 0;
+        }
+        for (var i = 0; i < codeLengths; i++) {
+            lengths[inflate.codeLengthOrder[i]] = inflate.bits(reader, 3);
+        }
+        var table = inflate.table(lengths);
+        lengths = [];
+        while (lengths.length < literals + distances) {
+            var symbol = inflate.symbol(reader, table);
+            var repeat = 0, value = 0;
+            if (symbol < 16) {
+                lengths.push(symbol);
+                continue;
+            } else if (symbol == 16) {
+                value = lengths[lengths.length - 1];
+                repeat = 3 + inflate.bits(reader, 2);
+            } else if (symbol == 17) {
+                repeat = 3 + inflate.bits(reader, 3);
+            } else {
+                repeat = 11 + inflate.bits(reader, 7);
+            }
+            for (var i = 0; i < repeat; i++) {
+                lengths.push(value);
+            }
+        }
+        return [inflate.table(lengths.slice(0, literals)),
+            inflate.table(lengths.slice(literals))];
+    }
+}
+
+inflate.fixed = (function() {
+    var lengths = [];
+    for (var i = 0; i < 288; i++) {
+        lengths.push(i < 144 ? 8 : i < 256 ? 9 : i < 280 ? 7 : 8);
+    }
+    var distances = [];
+    for (var i = 0; i < 30; i++) {
+        distances.push(5);
+    }
+    return {
+        lengths     : inflate.table(lengths),
+        distances   : inflate.table(distances)
+    };
+})();
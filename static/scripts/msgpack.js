@@ -0,0 +1,88 @@
+msgpack = {
+    // Just enough msgpack to read what the server sends.
+    // Works on binary strings (one char per byte), as produced by atob.
+    decode: function(bytes) {
+        var reader = {
+            bytes   : bytes,
+            pos     : 0
+        };
+        return msgpack.read(reader);
+    },
+    fromBase64: function(data) {
+        return msgpack.decode(atob(data));
+    },
+    byte: function(reader) {
+        return reader.bytes.charCodeAt(reader.pos++);
+    },
+    uint: function(reader, size) {
+        var n = 0;
+        for (var i = 0; i < size; i++) {
+            n = n * 256 + msgpack.byte(reader);
+        }
+        return n;
+    },
+    int: function(reader, size) {
+        var n = msgpack.uint(reader, size);
+        var limit = Math.pow(2, size * 8);
+        return n >= limit / 2 ? n - limit : n;
+    },
+    float: function(reader, size) {
+        var buffer = new ArrayBuffer(size);
+        var view = new DataView(buffer);
+        for (var i = 0; i < size; i++) {
+            view.setUint8(i, msgpack.byte(reader));
+        }
+        return size == 4 ? view.getFloat32(0) : view.getFloat64(0);
+    },
+    str: function(reader, length) {
+        var raw = reader.bytes.substr(reader.pos, length);
+        reader.pos += length;
+        return decodeURIComponent(escape(raw)); // utf-8 -> native string
+    },
+    array: function(reader, length) {
+        var out = [];
+        for (var i = 0; i < length; i++) {
+            out.push(msgpack.read(reader));
+        }
+        return out;
+    },
+    map: function(reader, length) {
+        var out = {};
+        for (var i = 0; i < length; i++) {
+            var key = msgpack.read(reader);
+            out[key] = msgpack.read(reader);
+        }
+        return out;
+    },
+    read: function(reader) {
+        var type = msgpack.byte(reader);
+        if (type < 0x80) { return type; }                   // positive fixint
+        if (type < 0x90) { return msgpack.map(reader, type & 0x0f); }
+        if (type < 0xa0) { return msgpack.array(reader, type & 0x0f); }
+        if (type < 0xc0) { return msgpack.str(reader, type & 0x1f); }
+        if (type >= 0xe0) { return type - 0x100; }          // negative fixint
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: case 0xd9: return msgpack.str(reader, msgpack.uint(reader, 1));
+            case 0xc5: case 0xda: return msgpack.str(reader, msgpack.uint(reader, 2));
+            case 0xc6: case 0xdb: return msgpack.str(reader, msgpack.uint(reader, 4));
+            case 0xca: return msgpack.float(reader, 4);
+            case 0xcb: return msgpack.float(reader, 8);
+            case 0xcc: return msgpack.uint(reader, 1);
+            case 0xcd: return msgpack.uint(reader, 2);
+            case 0xce: return msgpack.uint(reader, 4);
+            case 0xcf: return msgpack.uint(reader, 8);
+            case 0xd0: return msgpack.int(reader, 1);
+            case 0xd1: return msgpack.int(reader, 2);
+            case 0xd2: return msgpack.int(reader, 4);
+            case 0xd3: return msgpack.int(reader, 8);
+            case 0xdc: return msgpack.array(reader, msgpack.uint(reader, 2));
+            case 0xdd: return msgpack.array(reader, msgpack.uint(reader, 4));
+            case 0xde: return msgpack.map(reader, msgpack.uint(reader, 2));
+            case 0xdf: return msgpack.map(reader, msgpack.uint(reader, 4));
+        }
+        throw "msgpack: unsupported type 0x" + type.toString(16);
+    }
+}
@@ -16,18 +16,29 @@ api = {
     lastId: 0,
     pending: {},
     handlers: {},
+    inputBuffer: [],
+    inputTimer: null,
+    inputWindow: 10, // ms to gather keys for after sending some
+    tracing: /[?&]trace\b/.test(location.search), // add ?trace to the url
+    traces: {}, // trace id -> when its input was sent
+    nextTrace: 0,
+    lastFrame: null, // when the last change arrived and was drawn
     messages: { 
         screen      : "%",
         changes     : "?",
+        history     : "H",
         settings    : "s",
         hello       : "h",
         keypress    : "k",
+        input       : "i",
         cursor      : "_",
         error       : "e",
         chat        : ":",
         leave       : "l",
         status      : "u",
-        owner       : "~"
+        owner       : "~",
+        trace       : "t",
+        traceReport : "T"
     },
     colorsByName: {
         black   : 0,
@@ -42,13 +53,28 @@ api = {
     colorsByNumber: [
         "black", "red", "green", "brown", "blue", "magenta", "cyan", "white"
     ],
-    connect: function() {
-        this.socket = io.connect('/api');
+    encodings: (typeof msgpack == 'undefined') ? ["json"] : ["msgpack", "json"],
+    dictionary: null, // request for the deflate encoding's preset dictionary
+    inflater: null, // the deflate stream from the server, once there is one
+    connect: function(endpoint) {
+        this.socket = io.connect(endpoint || '/api');
         this.socket.on("message", this.handleMessage);
         return this.socket
     },
+    decode: function(data) {
+        // The server may use any encoding we offered, so check each message.
+        if (data.charAt(0) == 'm') {
+            return msgpack.fromBase64(data.substr(1));
+        }
+        if (data.charAt(0) == 'z') {
+            return msgpack.decode(inflate.decode(api.inflater,
+                atob(data.substr(1))));
+        }
+        return $.parseJSON(data);
+    },
     handleMessage: function(data) {
-        var passedObject = $.parseJSON(data);
+        var arrived = new Date().getTime();
+        var passedObject = api.decode(data);
         for (i in api.pending) {
             if (i == passedObject.id) {
                 api.pending[i].resolveWith(api, passedObject.response.slice(1));
@@ -63,6 +89,9 @@ api = {
                 api.handlers[type][i].apply(api, passedObject.response.slice(1));
             }
         }
+        if (type == api.messages.changes) {
+            api.lastFrame = {arrived: arrived, drawn: new Date().getTime()};
+        }
     },  
     on: function(type, handler) {
         if (type in api.handlers) {
@@ -86,12 +115,49 @@ api = {
         this.lastId++;
         return def;
     },
+    notify: function(msg, args) {
+        // Like request, but asks for no reply.
+        if (this.socket === null) { throw "not connected"; }
+
+        this.socket.send(JSON.stringify({
+            request : [msg].concat(args)
+        }));
+    },
+    loadDictionary: function(url) {
+        // Fetches the dictionary as a binary string, if we can inflate.
+        if (typeof inflate == 'undefined' || typeof msgpack == 'undefined') {
+            api.dictionary = $.Deferred().reject();
+            return;
+        }
+        api.dictionary = $.ajax({
+            url         : url,
+            dataType    : "text",
+            mimeType    : "text/plain; charset=x-user-defined"
+        });
+    },
     requestSettings: function() {
-        return api.request(api.messages.settings, []);
+        // Offers deflate once the dictionary is here, starting a fresh
+        // stream to match the one the server starts with its reply.
+        var settings = $.Deferred();
+        api.dictionary.always(function(dictionary) {
+            var encodings = api.encodings;
+            if (api.dictionary.state() == "resolved") {
+                api.inflater = inflate.stream(dictionary);
+                encodings = ["deflate"].concat(encodings);
+            }
+            api.request(api.messages.settings, [{encodings: encodings}]).done(
+                function() { settings.resolveWith(api, arguments); });
+        });
+        return settings;
     },
     requestChanges: function(lastChange) {
         return api.request(api.messages.changes, [lastChange]);
     },
+    requestHistory: function(start, count) {
+        // Scrollback lines from start on; a negative start counts back from
+        // the newest line.
+        return api.request(api.messages.history, [start, count]);
+    },
     requestScreen: function() {
         return api.request(api.messages.screen, []);
     },
@@ -101,6 +167,44 @@ api = {
     requestKeypress: function(k) {
         return api.request(api.messages.keypress, [k]);
     },
+    sendInput: function(keys) {
+        // The first keys go out at once; anything typed or pasted in the
+        // next inputWindow ms is gathered up and sent together.
+        api.inputBuffer = api.inputBuffer.concat(keys);
+        if (api.inputTimer === null) {
+            api.flushInput();
+        }
+    },
+    flushInput: function() {
+        if (api.inputBuffer.length == 0) {
+            api.inputTimer = null;
+            return;
+        }
+        if (api.tracing) {
+            var trace = api.nextTrace++;
+            api.traces[trace] = new Date().getTime();
+            api.notify(api.messages.input, [api.inputBuffer, trace]);
+        } else {
+            api.notify(api.messages.input, [api.inputBuffer]);
+        }
+        api.inputBuffer = [];
+        api.inputTimer = setTimeout(api.flushInput, api.inputWindow);
+    },
+    finishTrace: function(trace, stamps) {
+        // The server's trace follows the frame it is about, so that frame is
+        // the last one drawn.
+        var sent = api.traces[trace];
+        delete api.traces[trace];
+        if (sent === undefined || api.lastFrame === null) { return; }
+        var total = api.lastFrame.arrived - sent;
+        var timings = {
+            network : Math.max(0, total - stamps.send),
+            render  : api.lastFrame.drawn - api.lastFrame.arrived
+        };
+        console.log("input " + trace + ": " + total + "ms in all; server " +
+            JSON.stringify(stamps) + ", client " + JSON.stringify(timings));
+        api.notify(api.messages.traceReport, [trace, timings]);
+    },
     requestChat: function(message) {
         return api.request(api.messages.chat, [message]);
     },
@@ -173,6 +277,14 @@ function createConsole(owner, rows, cols) {
         redrawRow(rowY);
     }
 
+    function replaceCells (rowY, startX, newCells) {
+        var row = cnsGrid[rowY];
+        for (var i = 0; i < newCells.length && startX + i < cols; i++) {
+            row[startX + i] = newCells[i];
+            redrawChar(startX + i, rowY);
+        }
+    }
+
     function resolveColors(scheme, pair) {
         var bgIdx = pair % 8;
         var fgIdx = (pair >> 3) % 8;
@@ -342,7 +454,7 @@ function createConsole(owner, rows, cols) {
                 return null;
             }
         },
-        send: api.requestKeypress
+        send: api.sendInput
     };
 
     var changeOwner = function (newOwner) {
@@ -363,6 +475,7 @@ function createConsole(owner, rows, cols) {
 
     return {
         replaceRow: replaceRow,
+        replaceCells: replaceCells,
         moveCursor: moveCursor,
         setColorScheme: setColorScheme,
         changeOwner: changeOwner
@@ -460,11 +573,23 @@ function createChatPane(region) {
 
 var first = true;
 
-sock = api.connect();
+var join = function () {
+    // Live frames only carry what changed since the one before, so every
+    // connection, reconnects included, starts from a whole screen.
+    api.requestHello();
+    api.requestScreen();
+    api.requestOwner();
+}
+
+api.loadDictionary(webtermDictionary);
+sock = api.connect(webtermEndpoint);
 sock.on("connect", function () {
     api.requestSettings().done(
         function (settings) {
-            if (!first) { return; }
+            if (!first) {
+                join();
+                return;
+            }
             first = false;
             var rows = settings.rows;
             var cols = settings.cols;
@@ -483,19 +608,27 @@ sock.on("connect", function () {
                     cns.replaceRow(i, expandRow(row));
                 }
             });
-            api.on("?", function(changes) {
+            api.on("?", function(changes, cursor) {
                 for (var i = 0; i < changes.length; i++) {
                     var change = changes[i];
                     var changeNumber = change[0]
                     var lineNumber = change[1];
                     var line = change[2];
-                    cns.replaceRow(lineNumber, expandRow(line));
+                    if (change.length > 3) {
+                        cns.replaceCells(lineNumber, change[3], expandRow(line));
+                    } else {
+                        cns.replaceRow(lineNumber, expandRow(line));
+                    }
+                }
+                if (cursor) {
+                    cns.moveCursor(cursor[0], cursor[1]);
                 }
             });
             
             api.on("_", cns.moveCursor);
 
             api.on(api.messages.owner, cns.changeOwner);
+            api.on(api.messages.trace, api.finishTrace);
 
             api.on(api.messages.chat, chat.addChat);
             api.on(api.messages.status, chat.addStatus);
@@ -522,9 +655,7 @@ sock.on("connect", function () {
              * OK, start!
              */
 
-            api.requestHello();
-            api.requestScreen();
-            api.requestOwner();
+            join();
         }
     );
 });
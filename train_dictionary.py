@@ -0,0 +1,88 @@
+#!/usr/bin/python
+"""
+Builds the preset dictionary for the deflate encoding from terminal output.
+
+Replays streams through the frame pipeline the way bench.py does and collects
+the pieces of the messages clients are sent: the encoded lines and spans, and
+the envelope around them. The pieces worth the most, times seen by length,
+go into the dictionary, the best of them last, where deflate reaches them
+most cheaply. Train on recordings of the programs you actually serve with -f.
+"""
+
+import argparse
+
+import msgpack
+
+from bench import streams, recorded
+from webterm.termsess import TerminalSession
+from webterm.app import AppState
+from webterm.messages import ChangeMessage, pack_response, DICTIONARY_PATH
+from webterm import config
+
+ENVELOPE_BYTES = 16 # of each message, taken as a piece of its own
+
+class PieceCounter(object):
+    """
+    Stands in for a namespace, counting the pieces of every frame.
+    """
+    def __init__(self):
+        self.counts = {}
+    def add(self, piece):
+        self.counts[piece] = self.counts.get(piece, 0) + 1
+    def frame(self, changes, cursor):
+        self.add(pack_response(ChangeMessage(changes, cursor),
+            "deflate")[:ENVELOPE_BYTES])
+        for change in changes:
+            self.add(msgpack.packb(change[2]))
+
+def count(chunks, rows, cols, counter):
+    state = AppState("train", "/train", "train", [], ".")
+    state.subscribers = [counter]
+    session = TerminalSession("train", [], ".", rows = rows, cols = cols)
+    session.open_screen(state.add_frame)
+    for chunk in chunks:
+        session.stream.feed(chunk)
+        session.compose_frame()
+
+def build(counts, size):
+    """
+    Returns the best pieces that fit in size bytes, the best last. Pieces
+    already contained in a better one are left out.
+    """
+    chosen = []
+    total = 0
+    for piece, n in sorted(counts.iteritems(),
+            key = lambda i: i[1] * len(i[0]), reverse = True):
+        if n < 2 or total + len(piece) > size:
+            continue
+        if any(piece in i for i in chosen):
+            continue
+        chosen.append(piece)
+        total += len(piece)
+    return "".join(reversed(chosen))
+
+def main(names, files, rows, cols, size, out):
+    counter = PieceCounter()
+    for name in names:
+        count(streams[name](rows, cols), rows, cols, counter)
+    for path in files:
+        count(recorded(path), rows, cols, counter)
+    dictionary = build(counter.counts, size)
+    with open(out, "wb") as f:
+        f.write(dictionary)
+    print "%d bytes from %d distinct pieces written to %s" % (
+        len(dictionary), len(counter.counts), out)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("train_dictionary", description = 'builds the preset dictionary for the deflate encoding',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s'    , '--stream'    , action='append', choices=sorted(streams), help="built-in stream to train on (default: all of them)")
+    parser.add_argument('-f'    , '--file'      , action='append', default=[], help="file of recorded pty output to train on")
+    parser.add_argument('-r'    , '--rows'      , type=int, default=config.ROWS         , help="screen rows")
+    parser.add_argument('-c'    , '--cols'      , type=int, default=config.COLS         , help="screen columns")
+    parser.add_argument('-n'    , '--size'      , type=int, default=16384               , help="most bytes of dictionary")
+    parser.add_argument('-o'    , '--output'    , type=str, default=DICTIONARY_PATH     , help="file to write the dictionary to")
+
+    g = parser.parse_args()
+    names = g.stream or ([] if g.file else sorted(streams))
+    main(names, g.file, g.rows, g.cols, g.size, g.output)
@@ -2,93 +2,166 @@ from gevent import monkey
 monkey.patch_all()
 
 from flask import Flask, render_template, Response
-from flask import request
+from flask import request, abort
 
-from socketio import socketio_manage
+from socketio import socketio_manage, packet
 from socketio.server import SocketIOServer
 from socketio.namespace import BaseNamespace
 from werkzeug.serving import run_with_reloader
 
 from termsess import TerminalSession
-from util import synchronized, Category
+from worker import WorkerSession
+from recording import Recorder, Playback
+from relay import RelaySession
+from snapshot import Snapshot
+from frontend import HubNamespace, HubSession, follow_hub
+from util import Category, RateMeter
 from messages import (ChangeMessage, ScreenMessage, HelloMessage, ErrorMessage,
-        StatusMessage, SettingsMessage, OkMessage, CursorMessage, OwnerMessage,
-        pack, unpack)
+        StatusMessage, SettingsMessage, OkMessage, OwnerMessage, TraceMessage,
+        HistoryMessage, Prepacked, Deflater, pack_response, unpack)
 import messages
+import metrics
 
 from collections import deque
 
+import os
 import time
+import gevent
+
 from chat import Chat
 
 from config import *
 
-from threading import Thread # Must happen *after* monkeypatching
-
 app = Flask(__name__)
 app.secret_key = (
     SECRET_KEY
 )
 
 class ChangeTable(object):
+    """
+    Numbers changes as they are made and remembers the most recent change to
+    each line, which is all catching a client up takes. The same index
+    doubles as the current screen.
+
+    Changes are stored already encoded, as immutable snapshots of the line at
+    the time it changed. A client more than maxchanges changes behind is
+    sent a screen instead, which is cached for everyone.
+
+    Only the terminal's reader adds changes. It replaces the index rather than
+    changing it, so anyone else can read a consistent snapshot of it at any
+    time without locking.
+    """
     def __init__(self, maxchanges):
         self.maxchanges = maxchanges
-        self.offset = 0
-        self.changes = []
         self.next_idx = 0
+        self.latest = {} # line_number -> most recent change to that line
+    @property
+    def offset(self):
+        return max(0, self.next_idx - self.maxchanges)
     def has_change(self, number):
-        return (number > self.offset
-            and number < self.offset + len(self.changes))
-    def add_change(self, line_number, line):
-        if len(self.changes) == self.maxchanges:
-            self.changes = self.changes[1:]
-            self.offset += 1
-        self.changes.append((self.next_idx, line_number, line,))
-        self.next_idx += 1
+        return self.offset <= number <= self.next_idx
+    def add_changes(self, lines):
+        """
+        Adds a change for each (line_number, line) and returns the changes.
+        """
+        latest = dict(self.latest)
+        out = []
+        for change_number, (line_number, line) in enumerate(lines,
+                self.next_idx):
+            change = (change_number, line_number, line)
+            latest[line_number] = change
+            out.append(change)
+        self.latest = latest
+        self.next_idx += len(out)
+        return out
     def changes_after(self, change_number):
-        return self.changes[change_number - self.offset:]
-
-appstate = Category()
+        """
+        Returns the latest change to each line changed since change_number,
+        sorted by line number.
+        """
+        latest = self.latest
+        return sorted(
+            (i for i in latest.itervalues() if i[0] >= change_number),
+            key = lambda i: i[1])
+    def screen(self):
+        """
+        Returns the encoded lines of the screen, top to bottom.
+        """
+        latest = self.latest
+        return [latest[i][2] for i in sorted(latest)]
 
 class AppState(object):
-    def __init__(self):
+    """
+    Everything belonging to one terminal: the session itself, its change
+    table, the namespace its clients connect to, its chat and its owner.
+
+    session_type is what to run the command with, if not a TerminalSession or
+    WorkerSession, and namespace_type what to serve clients with, if not an
+    ApiNamespace.
+    """
+    def __init__(self, name, endpoint, command, args, working_dir,
+            session_type = None, namespace_type = None):
+        self.name = name
+        self.command = command
+        self.args = args
+        self.working_dir = working_dir
+        self.session_type = session_type
         self.session = None
+        self.recorder = None
+        self.snapshot = None
+        self.start_lock = Category()
         self.changes = ChangeTable(MAX_CHANGES)
         self.subscribers = []
-        self.chat = Chat(self, ApiNamespace)
+        namespace_type = namespace_type or ApiNamespace
+        self.namespace = type(namespace_type.__name__, (namespace_type,), {
+            "sockets"   : {},
+            "endpoint"  : endpoint,
+            "state"     : self
+        })
+        self.add_subscriber(self.namespace)
+        self.chat = Chat(self, self.namespace)
         self.owner = None
+        # (change_number, Prepacked screen_message), replaced, never changed
+        self.keyframe = None
+        self.frame_rate = RateMeter()
+        self.cursor = None
+        # (client, trace_id, {stage: time}) for traced inputs still waiting
+        # for a frame; replaced, never changed
+        self.traces = []
 
-    @synchronized(appstate)
     def start(self):
-        if self.session:
-            return
-        self.session = TerminalSession(COMMAND, ARGS, WORKING_DIR,
-            rows=ROWS, cols=COLS, restart=True)
-        self.session.start(self.add_change, self.move_cursor)
-        self.start_processdaemon()
-
-    def start_processdaemon(self):
-        Thread(target = self.processdaemon).start()
-        # cheat at getting fast updates
-
-    def processdaemon(self):
-        last_cursor = self.session.screen.cursor
-        while True:
-            self.session.process()
-            time.sleep(0.01)
-            new_cursor = self.session.screen.cursor
-            if (last_cursor.x != new_cursor.x or
-                last_cursor.y != new_cursor.y):
-                self.move_cursor(new_cursor)
-            last_cursor = new_cursor
+        with self.start_lock:
+            if self.session:
+                return
+            session_type = self.session_type or (WorkerSession
+                if SESSION_WORKERS else TerminalSession)
+            if RECORDING_DIR and not self.session_type:
+                self.recorder = Recorder(os.path.join(RECORDING_DIR, "%s-%s"
+                    % (self.name, time.strftime("%Y%m%d-%H%M%S"))),
+                    ROWS, COLS, lambda: (self.changes.screen(), self.cursor))
+            session = session_type(self.command, self.args,
+                self.working_dir, rows=ROWS, cols=COLS, restart=True,
+                max_fps=MAX_FPS, name=self.name)
+            session.start(self.add_frame)
+            if SNAPSHOT_DIR and FRONTEND_ROLE != "worker":
+                # The session may only know its size once it has started.
+                snapshot = Snapshot(os.path.join(SNAPSHOT_DIR, "%s.screen"
+                    % self.name.replace("/", "-")), session.params["rows"],
+                    session.params["cols"])
+                snapshot.add_frame(self.changes.latest.values(), self.cursor)
+                self.snapshot = snapshot
+            self.session = session
 
     def api_handle(self, client, message):
         handlers = {
             "?": self.handle_change_request,
             "%": self.handle_screen_request,
             "s": self.handle_settings_request,
+            "H": self.handle_history_request,
             "h": self.handle_hello_request,
             "k": self.handle_keypress_request,
+            "i": self.handle_input_request,
+            "T": self.handle_trace_request,
             "l": self.handle_leave_request,
             ":": self.handle_chat_request,
             "~": self.handle_owner_request,
@@ -96,57 +169,141 @@ class AppState(object):
 
         if not self.session:
             self.start()
-        self.session.process()
         tag, args = message[0], message[1:]
+        if tag in getattr(self.session, "forwarded", ()):
+            return self.session.forward(client, message)
         try:
             hndlr = handlers[tag]
         except KeyError:
             return ErrorMessage("unrecognized request: %s" % tag) 
         return hndlr(client, *args)
 
-    @synchronized(appstate)
-    def add_change(self, line_number, line):
-        idx = self.changes.next_idx
-        self.changes.add_change(line_number, line)
-        for i in self.subscribers:
-            i.change(idx, line_number, line)
-
-    @synchronized(appstate)
-    def move_cursor(self, cursor):
+    def add_frame(self, lines, cursor):
+        """
+        Records a frame from the session and sends it out. Only ever called
+        by the session's reader, so it is the one writer of the change table.
+        """
+        started = time.time()
+        self.frame_rate.tick()
+        metrics.frames.inc(labels = (self.name,))
+        if cursor:
+            self.cursor = cursor
+        changes = self.changes.add_changes(
+            (line_number, line) for line_number, line, spans in lines)
+        if self.recorder:
+            self.recorder.add_frame(changes, cursor)
+        if self.snapshot:
+            self.snapshot.add_frame(changes, cursor)
+        # Clients watching live already have the previous version of each
+        # line, so they only need the spans that differ from it.
+        live = []
+        for change, (line_number, line, spans) in zip(changes, lines):
+            if spans is None:
+                live.append(change)
+            else:
+                live.extend((change[0], line_number, span, column)
+                    for column, span in spans)
         for i in self.subscribers:
-            i.cursor(cursor)
+            i.frame(live, cursor)
+        metrics.stage_seconds.time(started, ("frame",))
+        if self.traces:
+            self.finish_traces(started)
+
+    def finish_traces(self, framed):
+        """
+        Sends a trace_message for every traced input this frame answers:
+        those written to the terminal before the read that made the frame.
+        """
+        read = self.session.last_read
+        sent = time.time()
+        waiting = []
+        for client, trace_id, stamps in self.traces:
+            if stamps["written"] > read:
+                if sent - stamps["received"] < TRACE_TIMEOUT:
+                    waiting.append((client, trace_id, stamps))
+                continue
+            received = stamps["received"]
+            for stage, since, until in [
+                    ("pty_write", received, stamps["written"]),
+                    ("child", stamps["written"], read),
+                    ("pipeline", read, framed),
+                    ("fanout", framed, sent)]:
+                metrics.input_seconds.observe(max(0, until - since),
+                    (self.name, stage))
+            ms = lambda t: round((t - received) * 1000, 3)
+            client.msg(TraceMessage(trace_id, {
+                "write" : ms(stamps["written"]),
+                "read"  : ms(read),
+                "frame" : ms(framed),
+                "send"  : ms(sent)
+            }))
+        self.traces = waiting
 
     def add_subscriber(self, other):
-        self.subscribers.append(other)
+        self.subscribers = self.subscribers + [other]
 
     def handle_change_request(self, client, change_number):
         if not self.changes.has_change(change_number):
-            return self.handle_screen_request(None)
-        changes = self.changes.changes_after(change_number)
-        out = {}
-        for i in changes:
-            line_number = i[1]
-            out[line_number] = i
-        changes = sorted(out.values(), key = lambda i: i[1])
-        return ChangeMessage(changes)
-
-    @synchronized(appstate)
-    def handle_screen_request(self, client):
-        return ScreenMessage(self.changes.next_idx, self.session.screen)
+            return self.handle_screen_request(client)
+        return ChangeMessage(self.changes.changes_after(change_number))
 
-    def handle_settings_request(self, client):
+    def handle_screen_request(self, client):
+        return self.screen_message()
+
+    def screen_message(self):
+        """
+        Returns the cached keyframe, rebuilt only when the screen has changed
+        since, so everyone asking for the screen between two frames shares
+        one message, packed once per encoding. The lines are already encoded,
+        so rebuilding it is cheap.
+        """
+        current = self.changes.next_idx
+        keyframe = self.keyframe
+        if not keyframe or keyframe[0] != current:
+            keyframe = self.keyframe = (current, Prepacked(
+                ScreenMessage(current, self.changes.screen())))
+        return keyframe[1]
+
+    def handle_history_request(self, client, start, count):
+        scrollback = getattr(self.session, "scrollback", None)
+        if not scrollback:
+            return HistoryMessage(0, [], 0, 0)
+        if start < 0:
+            start = max(0, scrollback.end + start)
+        first, lines = scrollback.lines(start,
+            max(0, min(count, MAX_HISTORY_PAGE)))
+        return HistoryMessage(first, lines, scrollback.oldest, scrollback.end)
+
+    def handle_settings_request(self, client, options = None):
+        if options:
+            client.set_encoding(messages.choose_encoding(
+                options.get("encodings", [])))
         return SettingsMessage({
-            "rows": ROWS,
-            "cols": COLS
+            "rows": self.session.params["rows"],
+            "cols": self.session.params["cols"],
+            "encoding": client.encoding
         })
 
-    @synchronized(appstate)
     def handle_keypress_request(self, client, key):
+        g = self.handle_input_request(client, key)
+        return g if g else OkMessage()
+
+    def handle_input_request(self, client, keys, trace_id = None):
+        # No lock and no draining: the keys go straight to the pty in one
+        # write, and the reader picks up whatever comes back.
         if client != self.owner:
             return ErrorMessage("You are not the current arbiter.")
-        self.session.input_bytes(key)
-        self.session.process()
-        return OkMessage()
+        received = time.time()
+        self.session.input_bytes(keys)
+        if trace_id is not None:
+            self.traces = self.traces + [(client, trace_id,
+                {"received": received, "written": time.time()})]
+
+    def handle_trace_request(self, client, trace_id, timings):
+        for stage in ["network", "render"]:
+            if stage in timings:
+                metrics.input_seconds.observe(
+                    max(0, float(timings[stage]) / 1000), (self.name, stage))
         
     def handle_hello_request(self, client, hello):
         self.chat.handle_join(client)
@@ -170,41 +327,288 @@ class AppState(object):
             return OwnerMessage(messages.NONE)
     def change_owner(self, new):
         self.owner = new
-        for i in ApiNamespace.list_clients():
-            i.msg(self.handle_owner_request(i))
+        if hasattr(self.session, "owner_changed"):
+            self.session.owner_changed(new)
+        self.namespace.owner_changed(new)
+
+class SessionRegistry(object):
+    """
+    All the terminals this process serves, by name.
+
+    The default terminal is served at /api, as it always has been, and every
+    other one at /api/<name>.
+
+    In a multi-process server the hub serves its terminals through
+    HubNamespaces, and a worker runs none itself: it follows each from the
+    hub with a HubSession.
+    """
+    def __init__(self):
+        self.states = {}
+        self.default = None
+    def make_state(self, name, endpoint, command, args, working_dir,
+            session_type):
+        if FRONTEND_ROLE == "worker":
+            return AppState(name, endpoint, name, [], None, HubSession)
+        return AppState(name, endpoint, command, args, working_dir,
+            session_type, HubNamespace if FRONTEND_ROLE == "hub" else None)
+    def add(self, name, command, args, working_dir, default = False,
+            session_type = None):
+        endpoint = "/api" if default else "/api/%s" % name
+        state = self.make_state(name, endpoint, command, args, working_dir,
+            session_type)
+        self.states[name] = state
+        if default:
+            self.default = state
+        return state
+    def get(self, name):
+        return self.states.get(name)
+    def playback(self, name):
+        """
+        Returns the terminal playing the recording called name, setting one
+        up if need be, or None if there is no such recording.
+        """
+        key = "r/%s" % name
+        if key not in self.states:
+            if (not RECORDING_DIR or name != os.path.basename(name)
+                    or not os.path.exists(
+                        os.path.join(RECORDING_DIR, name + ".idx"))):
+                return None
+            states = dict(self.states)
+            states[key] = self.make_state(key, "/api/%s" % key,
+                os.path.join(RECORDING_DIR, name), [], None, Playback)
+            self.states = states
+        return self.states[key]
+    def namespaces(self):
+        return dict((i.namespace.endpoint, i.namespace)
+            for i in self.states.itervalues())
+
+class DroppableFrame(str):
+    """
+    A queued message that a client can do without, because a fresh screen
+    would tell it everything the message would.
+    """
+
+class Uncompressed(str):
+    """
+    A queued message for a client using a compressed encoding, packed but
+    not yet compressed or framed. Messages are compressed as they leave the
+    queue, so that the ones thrown away never get into the stream.
+    """
+    endpoint = None
+
+class DroppableUncompressed(DroppableFrame):
+    """
+    An Uncompressed message that is also a DroppableFrame.
+    """
+    endpoint = None
 
 class ApiNamespace(BaseNamespace):
+    """
+    Base class for the namespace of one terminal. AppState makes a subclass
+    for each terminal with its own sockets, endpoint and state.
+    """
     sockets = {}
+    endpoint = None
+    state = None
+    # Spectators have every change before this one, unless a batch of
+    # changes is waiting for spectator_flush to send it.
+    spectators_upto = 0
+    spectator_flush = None
+    last_spectator_frame = 0
     def initialize(self):
         self.data = {}
+        self.encoding = "json"
+        self.drops = 0
+        self.bytes_sent = 0
+    def set_encoding(self, encoding):
+        """
+        Starts sending in encoding. A connection has one deflate stream,
+        begun by the reply to the first settings request that chooses it and
+        kept from then on, whatever later settings requests ask for.
+        """
+        if self.encoding in messages.compressed:
+            return
+        self.encoding = encoding
+        queue = self.socket.client_queue
+        if encoding == "deflate" and not queue.compressor:
+            # The stream belongs to the connection, and takes each message as
+            # the connection's queue gives it up to be sent.
+            self.deflater = Deflater()
+            queue.compressor = self.compress
+    def compress(self, frame):
+        if not isinstance(frame, (Uncompressed, DroppableUncompressed)):
+            return frame
+        started = time.time()
+        frame = packet.encode({
+            "type"      : "message",
+            "data"      : self.deflater.deflate(frame),
+            "endpoint"  : frame.endpoint
+        })
+        metrics.stage_seconds.time(started, ("compress",))
+        self.bytes_sent += len(frame)
+        return frame
     def recv_connect(self):
-        type(self).sockets[id(self)] = self
+        # The socket set is replaced rather than changed, so a broadcast that
+        # is under way never sees it change underneath it.
+        cls = type(self)
+        sockets = dict(cls.sockets)
+        sockets[id(self)] = self
+        cls.sockets = sockets
     def recv_message(self, data):
         unpacked = unpack(data)
-        id_ = unpacked["id"]
-        response = state.api_handle(self, unpacked["request"])
-        self.send(pack({
-            "id"        : id_,
-            "response"  : response
-        }))
+        id_ = unpacked.get("id")
+        response = self.state.api_handle(self, unpacked["request"])
+        if id_ is not None:
+            self.send_frame(self.make_frame(
+                pack_response(response, self.encoding, id_), self.encoding))
+        elif response:
+            self.msg(response)
     def disconnect(self, *args, **kwargs):
-        if id(self) in type(self).sockets:
-            del type(self).sockets[id(self)]
-            state.handle_leave_request(self)
+        cls = type(self)
+        if id(self) in cls.sockets:
+            sockets = dict(cls.sockets)
+            del sockets[id(self)]
+            cls.sockets = sockets
+            if self.state.session:
+                self.state.api_handle(self, ["l"])
     @classmethod
-    def change(cls, change_number, line_number, newline):
-        cls.multicast(state.handle_change_request(None, change_number))
+    def owner_changed(cls, owner):
+        cls.catch_up_owner(owner)
+        for i in cls.list_clients():
+            i.msg(cls.state.handle_owner_request(i))
     @classmethod
-    def cursor(cls, cursor):
-        cls.multicast(CursorMessage(cursor))
+    def catch_up_owner(cls, owner):
+        """
+        Sends a new arbiter the batch spectators are still waiting for. Frames
+        reach it live from now on, and would otherwise pass the batch by.
+        """
+        if owner and cls.spectator_flush:
+            cls.send_all([owner],
+                ChangeMessage(cls.state.changes.changes_after(
+                    cls.spectators_upto), cls.state.cursor),
+                droppable = True)
     @classmethod
-    def multicast(cls, message):
-        for i in cls.list_clients():
-            i.msg(message)
+    def frame(cls, changes, cursor):
+        """
+        Sends a frame to the arbiter first, then to spectators.
+
+        Spectators get at most SPECTATOR_FPS frames a second. Frames that come
+        sooner are batched up and sent together once it is time.
+        """
+        message = Prepacked(ChangeMessage(changes, cursor))
+        owner = cls.state.owner
+        if owner:
+            cls.send_all([owner], message, droppable = True)
+        if cls.spectator_flush:
+            return
+        delay = (cls.last_spectator_frame + cls.spectator_interval()
+            - time.time())
+        if delay > 0:
+            cls.spectator_flush = gevent.spawn_later(delay, cls.flush_spectators)
+            return
+        cls.send_all(cls.list_spectators(), message, droppable = True)
+        cls.spectators_upto = cls.state.changes.next_idx
+        cls.last_spectator_frame = time.time()
+    @classmethod
+    def flush_spectators(cls):
+        """
+        Sends spectators one frame covering everything they have missed.
+        """
+        changes = cls.state.changes
+        cls.send_all(cls.list_spectators(),
+            ChangeMessage(changes.changes_after(cls.spectators_upto),
+                cls.state.cursor),
+            droppable = True)
+        cls.spectators_upto = changes.next_idx
+        cls.last_spectator_frame = time.time()
+        cls.spectator_flush = None
+    @classmethod
+    def spectator_interval(cls):
+        return 1.0 / SPECTATOR_FPS if SPECTATOR_FPS else 0.0
+    @classmethod
+    def list_spectators(cls):
+        owner = cls.state.owner
+        return [i for i in cls.list_clients() if i is not owner]
+    @classmethod
+    def multicast(cls, message, droppable = False):
+        cls.send_all(cls.list_clients(), message, droppable)
+    @classmethod
+    def send_all(cls, clients, message, droppable = False):
+        # Clients using the same encoding get the same bytes, so encode them
+        # once per encoding.
+        if not isinstance(message, Prepacked):
+            message = Prepacked(message)
+        frames = {}
+        for i in clients:
+            try:
+                frame = frames[i.encoding]
+            except KeyError:
+                started = time.time()
+                frame = frames[i.encoding] = cls.make_frame(
+                    pack_response(message, i.encoding), i.encoding, droppable)
+                metrics.stage_seconds.time(started, ("pack",))
+            started = time.time()
+            i.send_frame(frame)
+            metrics.stage_seconds.time(started, ("send",))
+    @classmethod
+    def make_frame(cls, data, encoding, droppable = False):
+        """
+        Makes what goes on a client's queue for packed data: the frame itself,
+        or for a compressed encoding the data to compress into one.
+        """
+        if encoding in messages.compressed:
+            frame = (DroppableUncompressed if droppable else Uncompressed)(data)
+            frame.endpoint = cls.endpoint
+            return frame
+        frame = cls.encode_frame(data)
+        return DroppableFrame(frame) if droppable else frame
+    @classmethod
+    def encode_frame(cls, data):
+        """
+        Wraps packed data in the socket.io framing used for a message sent to
+        any client of this namespace.
+        """
+        return packet.encode({
+            "type"      : "message",
+            "data"      : data,
+            "endpoint"  : cls.endpoint
+        })
+    def send_frame(self, frame):
+        if (isinstance(frame, DroppableFrame)
+                and self.queue_depth() >= MAX_CLIENT_QUEUE):
+            self.skip_to_latest()
+            return
+        self.queue_frame(frame)
+    def queue_frame(self, frame):
+        if not isinstance(frame, (Uncompressed, DroppableUncompressed)):
+            self.bytes_sent += len(frame) # or once it is compressed
+        metrics.messages_sent.inc(labels = (self.state.name,))
+        self.socket.put_client_msg(frame)
+    def queue_depth(self):
+        return self.socket.client_queue.qsize()
+    def skip_to_latest(self):
+        """
+        Throws away the frames still waiting to be sent to this client and
+        queues a fresh screen instead. Everything else stays queued, in order.
+
+        The fresh screen can itself be thrown away by the next skip, so a
+        client that stays behind never has more than one waiting.
+        """
+        queue = self.socket.client_queue
+        kept = []
+        while not queue.empty():
+            i = queue.get_queued(False)
+            if isinstance(i, DroppableFrame):
+                self.drops += 1
+            else:
+                kept.append(i)
+        for i in kept:
+            queue.put_nowait(i)
+        self.queue_frame(self.make_frame(pack_response(
+            self.state.screen_message(), self.encoding), self.encoding, True))
     def msg(self, message):
-        self.send(pack({
-            "response"  : message
-        }))
+        self.send_frame(self.make_frame(
+            pack_response(message, self.encoding), self.encoding))
     def status(self, statusmessage):
         self.msg(StatusMessage(statusmessage))
     def error(self, errormessage):
@@ -212,17 +616,70 @@ class ApiNamespace(BaseNamespace):
     @classmethod
     def list_clients(cls):
         return cls.sockets.values()
-state = AppState()
-state.add_subscriber(ApiNamespace)
+registry = SessionRegistry()
+if RELAY:
+    registry.add("relay", RELAY, [], None, default = True,
+        session_type = RelaySession)
+else:
+    for name, command in commands.iteritems():
+        if name != ACTIVE_COMMAND:
+            registry.add(name, command["command"], command.get("args", []),
+                command["working_dir"])
+    registry.add(ACTIVE_COMMAND, COMMAND, ARGS, WORKING_DIR, default = True)
+state = registry.default
+if FRONTEND_ROLE == "worker":
+    follow_hub(HUB_SOCKET, registry)
+
+def client_samples(measure):
+    return [((name, i.socket.sessid), measure(i))
+        for name, named in registry.states.iteritems()
+        for i in named.namespace.list_clients()]
+metrics.Collected("webterm_client_sent_bytes_total",
+    "Bytes queued for each client.", ("session", "client"),
+    lambda: client_samples(lambda i: i.bytes_sent), kind = "counter")
+metrics.Collected("webterm_client_queue_depth",
+    "Messages waiting to be sent to each client.", ("session", "client"),
+    lambda: client_samples(lambda i: i.queue_depth()))
+metrics.Collected("webterm_client_dropped_frames_total",
+    "Frames thrown away because each client fell behind.",
+    ("session", "client"),
+    lambda: client_samples(lambda i: i.drops), kind = "counter")
+metrics.Collected("webterm_change_table_fill_ratio",
+    "How much of each change table's catch-up window of MAX_CHANGES changes "
+    "is in use.", ("session",),
+    lambda: [((name, ), (named.changes.next_idx - named.changes.offset)
+        / float(MAX_CHANGES)) for name, named in registry.states.iteritems()])
 
 @app.route("/socket.io/<path:rest>")
 def socket_api(rest):
-    socketio_manage(request.environ, {"/api": ApiNamespace}, request)
+    socketio_manage(request.environ, registry.namespaces(), request)
     return "" # deal with view function greenlet error
 
 @app.route("/")
 def hello():
-    return render_template("main.html")
+    return render_template("main.html", endpoint = state.namespace.endpoint)
+
+@app.route("/s/<name>/")
+def session_page(name):
+    named = registry.get(name)
+    if not named:
+        abort(404)
+    return render_template("main.html", endpoint = named.namespace.endpoint)
+
+@app.route("/metrics")
+def metrics_page():
+    return Response(metrics.render(), mimetype = "text/plain; version=0.0.4")
+
+@app.route("/r/<name>/")
+def playback_page(name):
+    playing = registry.playback(name)
+    if not playing:
+        abort(404)
+    return render_template("main.html", endpoint = playing.namespace.endpoint)
+
+@app.route("/deflate.dict")
+def deflate_dictionary():
+    return Response(messages.DICTIONARY, mimetype = "application/octet-stream")
 
 @app.route("/style/")
 def style():
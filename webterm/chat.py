@@ -37,7 +37,7 @@ class Chat(object):
             self.change_owner(None)
     def greet(self, client):
         client.status("Welcome to webterm.")
-        client.status("Today's command is '%s'" % config.COMMAND)
+        client.status("Today's command is '%s'" % self.app_state.command)
         if self.is_authed(client):
             client.status(
                 "You are currently authed as %s." % self.get_auth(client))
@@ -340,6 +340,55 @@ class ChatCommands(object):
             )
         )
         self.chat.change_owner(None)
+    def cmd_status(self, client):
+        """
+        /status
+        Shows what the terminal is running and how many screen updates a second it is sending out.
+        """
+        state = self.chat.app_state
+        return StatusMessage("Running '%s' at %.1f frames/s (at most %s)."
+            % (state.command, state.frame_rate.rate(), config.MAX_FPS))
+    def cmd_queues(self, client):
+        """
+        /queues
+        Shows, for everyone watching, how many messages are waiting to be sent to them and how many frames they have skipped for being too far behind.
+        """
+        for i in self.chat.socket_manager.list_clients():
+            client.status("%s: %s queued, %s frames dropped" % (
+                self.chat.identify(i), i.queue_depth(), i.drops))
+    def cmd_seek(self, client, position):
+        """
+        /seek [[hours:]minutes:]seconds
+        When watching a recording, jumps to the given time in it.
+        Everyone watching shares the playback, so only the arbiter can do this.
+        """
+        session = self.chat.app_state.session
+        if not hasattr(session, "seek"):
+            return ErrorMessage("This is not a recording.")
+        if self.chat.find_owner() != client:
+            return ErrorMessage("You do not control the console.")
+        seconds = 0
+        for i in position.split(":"):
+            seconds = seconds * 60 + float(i)
+        session.seek(seconds)
+        self.chat.socket_manager.multicast(StatusMessage(
+            "%s jumped to %s." % (self.chat.identify(client), position)))
+    def cmd_speed(self, client, speed):
+        """
+        /speed times
+        When watching a recording, plays it the given number of times faster than it happened.
+        Everyone watching shares the playback, so only the arbiter can do this.
+        """
+        session = self.chat.app_state.session
+        if not hasattr(session, "set_speed"):
+            return ErrorMessage("This is not a recording.")
+        if self.chat.find_owner() != client:
+            return ErrorMessage("You do not control the console.")
+        if float(speed) <= 0:
+            return ErrorMessage("The speed must be more than 0.")
+        session.set_speed(float(speed))
+        self.chat.socket_manager.multicast(StatusMessage(
+            "%s set the speed to %sx." % (self.chat.identify(client), speed)))
     def cmd_arbiter(self, client):
         """
         /arbiter
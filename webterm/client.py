@@ -0,0 +1,165 @@
+"""
+A webterm client: talks to a server's API over socket.io 0.9 on a websocket,
+the way the browser does. Used by the load tester.
+"""
+import os
+import json
+import struct
+import base64
+import urllib2
+
+import gevent
+from gevent import socket
+from gevent.queue import Queue
+from socketio import packet
+
+from messages import unpack
+
+class ClientError(Exception): pass
+
+class WebSocket(object):
+    """
+    Just enough of a websocket client for socket.io: text frames out, masked
+    as a client's must be, and text frames in.
+    """
+    def __init__(self, host, port, path):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+        self.sock.sendall("\r\n".join([
+            "GET %s HTTP/1.1" % path,
+            "Host: %s:%s" % (host, port),
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-WebSocket-Key: %s" % base64.b64encode(os.urandom(16)),
+            "Sec-WebSocket-Version: 13",
+            "", ""]))
+        status = self.file.readline()
+        if " 101 " not in status:
+            raise ClientError("websocket refused: %s" % status.strip())
+        while self.file.readline() not in ("\r\n", ""):
+            pass # headers
+    def send(self, data, opcode = 1):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        header = chr(0x80 | opcode)
+        if len(data) < 126:
+            header += chr(0x80 | len(data))
+        elif len(data) < 1 << 16:
+            header += chr(0x80 | 126) + struct.pack("!H", len(data))
+        else:
+            header += chr(0x80 | 127) + struct.pack("!Q", len(data))
+        mask = os.urandom(4)
+        masked = bytearray(data)
+        for i in xrange(len(masked)):
+            masked[i] ^= ord(mask[i & 3])
+        self.sock.sendall(header + mask + str(masked))
+    def read(self, n):
+        s = self.file.read(n)
+        if len(s) < n:
+            raise ClientError("connection closed")
+        return s
+    def receive(self):
+        """
+        Returns the next message, or None once the server has closed.
+        """
+        message = ""
+        while True:
+            try:
+                first, second = map(ord, self.read(2))
+            except ClientError:
+                return None
+            length = second & 0x7f
+            if length == 126:
+                length, = struct.unpack("!H", self.read(2))
+            elif length == 127:
+                length, = struct.unpack("!Q", self.read(8))
+            data = self.read(length)
+            opcode = first & 0x0f
+            if opcode == 8: # close
+                return None
+            if opcode == 9: # ping
+                self.send(data, 10)
+                continue
+            if opcode == 10: # pong
+                continue
+            message += data
+            if first & 0x80: # that was the last piece
+                return message.decode("utf-8")
+    def close(self):
+        try:
+            self.send("", 8)
+        except socket.error:
+            pass
+        self.sock.close()
+
+class ApiClient(object):
+    """
+    One connection to a terminal's API. Responses, and messages nobody asked
+    for, arrive on the messages queue as (id, response), with id None unless
+    the message answers a request.
+    """
+    def __init__(self, host, port, endpoint = "/api"):
+        self.host = host
+        self.port = port
+        self.endpoint = endpoint
+        self.next_id = 0
+        self.messages = Queue()
+        self.ws = None
+
+    def connect(self):
+        handshake = urllib2.urlopen("http://%s:%s/socket.io/1/"
+            % (self.host, self.port)).read()
+        session_id = handshake.split(":")[0]
+        self.ws = WebSocket(self.host, self.port,
+            "/socket.io/1/websocket/%s" % session_id)
+        self.ws.send(packet.encode({"type": "connect",
+            "endpoint": self.endpoint}))
+        self.reader = gevent.spawn(self.read_loop)
+
+    def close(self):
+        if self.ws:
+            self.ws.close()
+            self.ws = None
+
+    def read_loop(self):
+        while True:
+            data = self.ws.receive()
+            if data is None:
+                self.messages.put(None)
+                return
+            message = packet.decode(data)
+            if message["type"] == "heartbeat":
+                self.ws.send(data)
+            elif (message["type"] == "message"
+                    and message["endpoint"] == self.endpoint):
+                unpacked = unpack(message["data"].encode("utf-8"))
+                self.messages.put((unpacked.get("id"), unpacked["response"]))
+
+    def send(self, body):
+        self.ws.send(packet.encode({
+            "type"      : "message",
+            "data"      : json.dumps(body),
+            "endpoint"  : self.endpoint
+        }))
+
+    def request(self, *request):
+        """
+        Sends a request and returns its id. The response turns up in messages.
+        """
+        id_ = self.next_id
+        self.next_id += 1
+        self.send({"id": id_, "request": list(request)})
+        return id_
+
+    def notify(self, *request):
+        """
+        Sends a request that expects no response.
+        """
+        self.send({"request": list(request)})
+
+    def receive(self, timeout = None):
+        """
+        Returns the next (id, response), or None if the connection closed.
+        """
+        return self.messages.get(timeout = timeout)
@@ -18,7 +18,50 @@ ACTIVE_COMMAND = "lcs"
 COMMAND = commands[ACTIVE_COMMAND]["command"]
 WORKING_DIR = commands[ACTIVE_COMMAND]["working_dir"]
 ARGS = []
-MAX_CHANGES = 1024
+MAX_CHANGES = 1024 # changes behind a client can be and still get just those
+# Most screen updates sent to clients per second while output floods in.
+# Updates answering a keypress are never held back.
+MAX_FPS = 50
+# Spectators get at most this many a second, so that the arbiter's echo
+# doesn't wait on the audience. 0 means the same rate as the arbiter.
+SPECTATOR_FPS = 15
+# Frames a client may fall behind by before we skip it to a fresh screen.
+MAX_CLIENT_QUEUE = 64
+# A command that exits within QUICK_EXIT seconds of starting is restarted
+# after RESTART_DELAY seconds, twice as long each time it does it again in a
+# row, up to RESTART_MAX_DELAY.
+QUICK_EXIT = 2
+RESTART_DELAY = 1
+RESTART_MAX_DELAY = 60
+# Run each terminal's pty and screen in a worker process of its own, so busy
+# terminals don't hold up the web process and can use more than one core.
+SESSION_WORKERS = False
+# Seconds a traced input waits for a frame before we give up on it.
+TRACE_TIMEOUT = 10
+# Record every session into this directory, to be played back at /r/<name>/.
+RECORDING_DIR = None
+RECORDING_KEYFRAME_INTERVAL = 10 # seconds between keyframes in a recording
+# Most bytes of compressed scrollback kept for each terminal, in blocks of
+# SCROLLBACK_BLOCK_LINES lines.
+SCROLLBACK_MEMORY = 4 << 20
+SCROLLBACK_BLOCK_LINES = 256
+MAX_HISTORY_PAGE = 500 # most lines of scrollback sent for one request
+# Relay the terminal at this url, like "http://origin:5000/api", instead of
+# running a command.
+RELAY = None
+# "username password" to take control upstream with when someone here is
+# arbiter.
+RELAY_AUTH = None
+RELAY_RETRY = 1 # seconds between attempts to reach a lost upstream
+# Keep each terminal's screen in a memory-mapped file in this directory,
+# <name>.screen, for other processes to read.
+SNAPSHOT_DIR = None
+# Serve clients from this many worker processes sharing the port, with the
+# terminals run by one more, the hub. 0 serves everything from one process.
+FRONTEND_WORKERS = 0
+FRONTEND_ROLE = None # "hub" or "worker" in a multi-process server
+HUB_SOCKET = None # path of the hub's socket, for workers to follow
+HUB_TIMEOUT = 10 # seconds a worker waits for the hub to answer a request
 ROWS = 30
 COLS = 80
 
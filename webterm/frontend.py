@@ -0,0 +1,377 @@
+"""
+Serving one port from several processes.
+
+The hub runs the terminals and keeps everything shared: chat, accounts and
+who is arbiter. Workers are forked from it with the listening socket and
+serve the clients between them. Each follows the hub's frame log, a local
+socket carrying every frame the hub makes, into a change table of its own, so
+catching clients up and framing messages for them is spread over all the
+workers. Requests that touch shared state are passed on to the hub and
+answered from there.
+
+Records on the hub's socket are msgpack, one after another:
+    worker -> hub:
+        ('start', name)                         start name, send its screen
+        ('req', name, client, seq, request)     a request from a client
+    hub -> worker:
+        ('screen', name, [[ line ]], cursor)    the whole screen, after start
+        ('frame', name, [[ (line_number, line, spans | None) ]], cursor)
+        ('reply', seq, response)                the answer to request seq
+        ('msg', name, client | None, message)   for one client, or everyone
+        ('owner', name, client | None)          the new arbiter
+Frames go to every worker, whether it has started the terminal or not.
+Clients are named by strings unique among all the workers.
+"""
+import os
+import hmac
+import hashlib
+import traceback
+
+import msgpack
+import gevent
+from gevent import socket, Timeout
+from gevent.event import AsyncResult, Event
+from gevent.queue import Queue
+from gevent.server import StreamServer
+
+from termsess import SessionStateError
+from server import WebtermServer
+from messages import StatusMessage, ErrorMessage
+from config import SECRET_KEY, HUB_TIMEOUT
+
+READ_SIZE = 65536
+
+class RemoteClient(object):
+    """
+    Stands in at the hub for a client of one of the workers.
+    """
+    def __init__(self, link, state, key):
+        self.link = link
+        self.state = state
+        self.key = key
+        self.data = {}
+        self.drops = "?" # the worker keeps its clients' queues, not us
+    def msg(self, message):
+        self.link.send(("msg", self.state.name, self.key, message))
+    def status(self, statusmessage):
+        self.msg(StatusMessage(statusmessage))
+    def error(self, errormessage):
+        self.msg(ErrorMessage(errormessage))
+    def queue_depth(self):
+        return "?"
+    def disconnect(self, *args, **kwargs):
+        namespace = self.state.namespace
+        if self.key in namespace.sockets:
+            sockets = dict(namespace.sockets)
+            del sockets[self.key]
+            namespace.sockets = sockets
+            self.link.clients.discard(self)
+
+class HubNamespace(object):
+    """
+    Stands in at the hub for the namespace of one terminal, reaching its
+    clients through the workers. AppState makes a subclass for each terminal,
+    as with ApiNamespace.
+    """
+    sockets = {} # key -> RemoteClient, replaced, never changed
+    endpoint = None
+    state = None
+    hub = None
+    @classmethod
+    def client(cls, link, key):
+        try:
+            return cls.sockets[key]
+        except KeyError:
+            client = RemoteClient(link, cls.state, key)
+            sockets = dict(cls.sockets)
+            sockets[key] = client
+            cls.sockets = sockets
+            link.clients.add(client)
+            return client
+    @classmethod
+    def frame(cls, changes, cursor):
+        """
+        Publishes the frame as the session made it, whole lines and spans, so
+        each worker can make the same changes in its own table.
+        """
+        latest = cls.state.changes.latest
+        spans = {} # line_number -> its spans, or None if it changed whole
+        for change in changes:
+            if len(change) > 3:
+                spans.setdefault(change[1], []).append((change[3], change[2]))
+            else:
+                spans[change[1]] = None
+        cls.hub.publish(("frame", cls.state.name,
+            [(line_number, latest[line_number][2], line_spans)
+                for line_number, line_spans in sorted(spans.iteritems())],
+            cursor))
+    @classmethod
+    def multicast(cls, message, droppable = False):
+        cls.hub.publish(("msg", cls.state.name, None, message))
+    @classmethod
+    def owner_changed(cls, owner):
+        cls.hub.publish(("owner", cls.state.name, owner.key if owner else None))
+        for i in cls.list_clients():
+            i.msg(cls.state.handle_owner_request(i))
+    @classmethod
+    def list_clients(cls):
+        return cls.sockets.values()
+
+def read_records(sock):
+    """
+    Yields each record read from sock until it closes.
+    """
+    unpacker = msgpack.Unpacker(use_list = False)
+    while True:
+        data = sock.recv(READ_SIZE)
+        if not data:
+            return
+        unpacker.feed(data)
+        for record in unpacker:
+            yield record
+
+class WorkerLink(object):
+    """
+    The hub's end of its socket to one worker. Records are written from a
+    queue of their own, so a slow worker never holds up a terminal.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.clients = set() # every RemoteClient behind this worker
+        self.queue = Queue()
+        self.writer = gevent.spawn(self.write_loop)
+    def send(self, record):
+        self.send_packed(msgpack.packb(record))
+    def send_packed(self, data):
+        self.queue.put(data)
+    def write_loop(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                return
+    def close(self):
+        self.queue.put(None)
+
+class Hub(object):
+    """
+    Serves the terminals in registry to the workers connecting to listener.
+    """
+    def __init__(self, listener, registry):
+        self.listener = listener
+        self.registry = registry
+        self.links = [] # replaced, never changed
+        HubNamespace.hub = self
+    def serve_forever(self):
+        StreamServer(self.listener, self.handle).serve_forever()
+    def publish(self, record):
+        data = msgpack.packb(record)
+        for i in self.links:
+            i.send_packed(data)
+    def handle(self, sock, address):
+        link = WorkerLink(sock)
+        self.links = self.links + [link]
+        try:
+            for record in read_records(sock):
+                self.dispatch(link, record)
+        except socket.error:
+            pass
+        finally:
+            self.links = [i for i in self.links if i is not link]
+            link.close()
+            sock.close() # so the worker knows to give up
+            for client in list(link.clients): # the worker died with them
+                client.state.api_handle(client, ["l"])
+    def find(self, name):
+        if name.startswith("r/"):
+            return self.registry.playback(name[2:])
+        return self.registry.get(name)
+    def dispatch(self, link, record):
+        # One bad record must not cost the worker its link, and with it
+        # every one of its clients.
+        try:
+            kind, name = record[0], record[1]
+            state = self.find(name)
+            if kind == "start":
+                state.start()
+                link.send(("screen", name, state.changes.screen(),
+                    state.cursor))
+            elif kind == "req":
+                key, seq, request = record[2:]
+                client = state.namespace.client(link, key)
+                response = state.api_handle(client, list(request))
+                link.send(("reply", seq, response))
+        except Exception:
+            print "An exception occurred handling %r from a worker." % (
+                record,)
+            traceback.print_exc()
+            if record[0] == "req" and len(record) > 3:
+                link.send(("reply", record[3],
+                    ErrorMessage("An exception occurred handling a request."
+                        + " Bother the maintainer to fix it.")))
+
+def serve_hub(listener, registry):
+    Hub(listener, registry).serve_forever()
+
+class HubLink(object):
+    """
+    A worker's end of its socket to the hub.
+    """
+    def __init__(self, path, registry):
+        self.registry = registry
+        self.sessions = {} # name -> the HubSession following it
+        self.clients = {} # key -> our client
+        self.replies = {} # seq -> AsyncResult for a request waiting on one
+        self.seq = 0
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.reader = gevent.spawn(self.read_loop)
+    def send(self, record):
+        self.sock.sendall(msgpack.packb(record))
+    def key(self, client):
+        key = "%d.%d" % (os.getpid(), id(client))
+        self.clients[key] = client
+        return key
+    def forget(self, client):
+        self.clients.pop("%d.%d" % (os.getpid(), id(client)), None)
+    def request(self, name, client, request):
+        """
+        Passes request on to the hub and returns its answer.
+        """
+        self.seq += 1
+        seq = self.seq
+        reply = self.replies[seq] = AsyncResult()
+        self.send(("req", name, self.key(client), seq, request))
+        try:
+            return reply.get(timeout = HUB_TIMEOUT)
+        except Timeout:
+            return ErrorMessage("The server took too long to answer.")
+        finally:
+            del self.replies[seq]
+    def read_loop(self):
+        for record in read_records(self.sock):
+            kind = record[0]
+            if kind == "reply":
+                reply = self.replies.get(record[1])
+                if reply:
+                    reply.set(record[2])
+                continue
+            session = self.sessions.get(record[1])
+            if not session:
+                continue
+            if kind == "screen":
+                session.load(record[2], record[3])
+            elif kind == "frame":
+                session.apply(record[2], record[3])
+            elif kind == "msg":
+                self.deliver(session.name, record[2], record[3])
+            elif kind == "owner":
+                named = self.registry.get(session.name)
+                named.owner = self.clients.get(record[2])
+                named.namespace.catch_up_owner(named.owner)
+        # Without the hub there is nothing left to serve.
+        os._exit(1)
+    def deliver(self, name, key, message):
+        if key is None:
+            named = self.registry.get(name)
+            if named:
+                named.namespace.multicast(message)
+        elif key in self.clients:
+            self.clients[key].msg(message)
+
+hub_link = None
+
+def follow_hub(path, registry):
+    global hub_link
+    hub_link = HubLink(path, registry)
+
+class HubSession(object):
+    """
+    Stands in, in a worker, for a session the hub runs. Takes the same
+    arguments as a TerminalSession, with the terminal's name as the command.
+    """
+    # Requests for the hub to answer: everything chat, arbiter or input.
+    forwarded = frozenset(":hikl~H")
+    def __init__(self, cmd, args, working_dir, **params):
+        self.name = cmd
+        self.params = params
+        self.running = False
+        self.last_read = 0
+        self.loaded = Event()
+
+    def start(self, framecallback):
+        if self.running:
+            raise SessionStateError("HubSession already running")
+        self.running = True
+        self.callback = framecallback
+        hub_link.sessions[self.name] = self
+        hub_link.send(("start", self.name))
+        # Wait for the screen, so that we never serve a blank one.
+        self.loaded.wait()
+
+    def end(self):
+        pass # the hub restarts the terminal, and we follow along
+
+    def load(self, lines, cursor):
+        self.callback([(line_number, line, None)
+            for line_number, line in enumerate(lines)], cursor)
+        self.loaded.set()
+
+    def apply(self, lines, cursor):
+        # Frames from before our screen are already in it.
+        if self.loaded.is_set():
+            self.callback(lines, cursor)
+
+    def forward(self, client, request):
+        response = hub_link.request(self.name, client, request)
+        if request[0] == "l":
+            hub_link.forget(client)
+            client.disconnect()
+        return response
+
+    def ready(self):
+        return self.running
+    def keypress(self, keycode):
+        pass
+    def input_text(self, s):
+        pass
+    def input_bytes(self, b):
+        pass
+
+def sign(sessid):
+    return hmac.new(SECRET_KEY, sessid, hashlib.sha1).hexdigest()[:16]
+
+class FrontendServer(WebtermServer):
+    """
+    A WebtermServer for a worker. A client's handshake and its connection
+    can land on different workers, so session ids are signed and any worker
+    takes up a session it is shown a good id for. Only the websocket
+    transport is offered, since it carries a whole session on one
+    connection.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("transports", ["websocket"])
+        super(FrontendServer, self).__init__(*args, **kwargs)
+    def get_socket(self, sessid = ''):
+        if not sessid:
+            # A handshake: hand out an id, and leave the session to be made
+            # by whichever worker the client connects to. Not socketio's own
+            # id: every worker forked with the same random state, so their
+            # ids would come out the same.
+            socket = self.make_socket()
+            sessid = os.urandom(12).encode("hex")
+            socket.sessid = "%s-%s" % (sessid, sign(sessid))
+            return socket
+        socket = self.sockets.get(sessid)
+        if socket:
+            socket.incr_hits()
+            return socket
+        unsigned, _, signature = sessid.rpartition("-")
+        if not hmac.compare_digest(signature, sign(unsigned)):
+            return None
+        socket = self.sockets[sessid] = self.make_socket()
+        socket.sessid = sessid
+        return socket
@@ -1,13 +1,136 @@
 import msgpack
 from functools import wraps
+from collections import OrderedDict
+import base64
 import json
-
-def pack(representation):
+import os
+import zlib
+
+LINE_CACHE_SIZE = 1024 # distinct encoded lines to remember
+CHAR_CACHE_SIZE = 4096 # distinct encoded chars to remember
+SPAN_GAP = 4 # unchanged cells worth resending to avoid starting a new span
+
+MSGPACK_PREFIX = "m"
+DEFLATE_PREFIX = "z"
+DEFLATE_LEVEL = 6
+# Terminal frames that deflate streams start out knowing, made by
+# train_dictionary.py. Clients fetch it from /deflate.dict.
+DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "deflate.dict")
+
+def pack_json(representation):
     return json.dumps(representation)
 
+def pack_msgpack(representation):
+    return MSGPACK_PREFIX + base64.b64encode(msgpack.packb(representation))
+
+packers = {
+    "json"      : pack_json,
+    "msgpack"   : pack_msgpack,
+    }
+
+def pack(representation, encoding = "json"):
+    return packers[encoding](representation)
+
+class Prepacked(object):
+    """
+    A response that is packed at most once per encoding, however many times
+    and to however many clients it is sent.
+    """
+    def __init__(self, message):
+        self.message = message
+        self.bodies = {}
+    def body(self, encoding):
+        encoding = body_encodings.get(encoding, encoding)
+        try:
+            return self.bodies[encoding]
+        except KeyError:
+            body = self.bodies[encoding] = body_packers[encoding](self.message)
+            return body
+
+body_packers = {
+    "json"      : json.dumps,
+    "msgpack"   : msgpack.packb,
+    }
+body_encodings = {
+    "deflate"   : "msgpack", # compressed later, one client at a time
+    }
+
+def envelope_json(body, id_):
+    if id_ is None:
+        return '{"response": %s}' % body
+    return '{"id": %s, "response": %s}' % (json.dumps(id_), body)
+
+def envelope_raw(body, id_):
+    response = msgpack.packb("response") + body
+    if id_ is None:
+        return "\x81" + response
+    return "\x82" + msgpack.packb("id") + msgpack.packb(id_) + response
+
+def envelope_msgpack(body, id_):
+    return MSGPACK_PREFIX + base64.b64encode(envelope_raw(body, id_))
+
+envelopes = {
+    "json"      : envelope_json,
+    "msgpack"   : envelope_msgpack,
+    "deflate"   : envelope_raw, # until the client's Deflater takes it
+    }
+compressed = frozenset(["deflate"]) # encodings compressed per client
+
+def load_dictionary():
+    try:
+        with open(DICTIONARY_PATH, "rb") as f:
+            return f.read()
+    except IOError:
+        return ""
+DICTIONARY = load_dictionary()
+
+class Deflater(object):
+    """
+    The deflate stream to one client. Every message is compressed with all
+    the earlier ones as context, starting with the dictionary.
+    """
+    def __init__(self):
+        # Python's zlib can't be given a dictionary, so compress it and
+        # throw the output away: the client puts the same bytes straight
+        # into its window, which is all a preset dictionary is.
+        self.compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15)
+        self.compressor.compress(DICTIONARY)
+        self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    def deflate(self, data):
+        """
+        Compresses the raw msgpack of a message into its deflate encoding.
+        """
+        out = self.compressor.compress(data) + self.compressor.flush(
+            zlib.Z_SYNC_FLUSH)
+        # Every flush ends in the same four bytes, so leave them out.
+        return DEFLATE_PREFIX + base64.b64encode(out[:-4])
+
+def pack_response(response, encoding = "json", id_ = None):
+    """
+    Packs a response in the envelope clients expect, with the id of the
+    request it answers if it answers one. The body of a Prepacked response is
+    spliced in as it is rather than packed again.
+    """
+    if not isinstance(response, Prepacked):
+        response = Prepacked(response)
+    return envelopes[encoding](response.body(encoding), id_)
+
 def unpack(representation):
+    if representation.startswith(MSGPACK_PREFIX):
+        return msgpack.unpackb(base64.b64decode(representation[1:]))
     return json.loads(representation)
 
+def choose_encoding(offered):
+    """
+    Picks the encoding to use with a client out of the ones it says it can
+    decode, falling back to json.
+    """
+    for i in offered:
+        if i in envelopes:
+            return i
+    return "json"
+
 """
 Protocol (after unpacking):
 
@@ -38,7 +161,36 @@ x | y
 
 ---- Vehicle ----
 
-TODO: update for Socket.IO
+Messages travel as Socket.IO text messages of the form
+{('id': int,) 'request': x} (client to server) or {'id': int, 'response': x}
+(server to client). The id is left out of responses the client didn't ask
+for.
+
+A request without an id gets no reply unless it fails, in which case the
+error_message arrives without an id.
+
+Each one is encoded in one of these ways:
+    json
+        Plain JSON text. Every client understands this and it is the
+        default.
+    msgpack
+        'm' followed by the base64 of the msgpack representation. Socket.IO
+        only carries text, hence the base64.
+    deflate
+        'z' followed by the base64 of the msgpack representation compressed
+        as raw deflate (RFC 1951). The messages of a connection are one
+        stream: each is flushed with a sync flush, less the 00 00 ff ff that
+        ends every sync flush, and may refer back to earlier ones. Before the
+        first, the stream's window holds the preset dictionary served at
+        /deflate.dict. The client decompresses each message by appending
+        00 00 ff ff and inflating it with the same window. A connection has
+        one stream, which starts with the settings_message that first chooses
+        this encoding. After that the connection keeps the encoding, and the
+        stream, whatever later settings_requests offer.
+
+A client may offer encodings in its settings_request. From then on the server
+may send it messages in any of them, so the client should look at each
+message to see which it is. Clients always send JSON.
 
 ---- Communications ----
 
@@ -72,30 +224,68 @@ screen_request: ['%']
     Similar to a change_request, but does not specify a change number and
     always receives a screen_message in reply.
 
-settings_request: ['s']
+settings_request: ['s', ({'encodings': [[ string ]]})]
     Server <-- Client
     Requests information about the terminal from the server.
 
-keypress_request: ['k', key]
+    The client may list the encodings it can decode, most preferred first.
+
+keypress_request: ['k', [[ key ]]]
     Server <-- Client
-    Asks the server to press a key.
+    Asks the server to press some keys.
     Server should reply with an OkMessage.
 
+input_request: ['i', [[ key ]], (trace_id)]
+    Server <-- Client
+    Like a keypress_request, but meant to be sent without an id and not
+    waited on. Clients should gather up keys pressed in quick succession and
+    send them in one of these.
+
+    If a trace_id is given, the server follows the first frame showing what
+    the keys did with a trace_message.
+
+trace_request: ['T', trace_id, {'network': ms, 'render': ms}]
+    Server <-- Client
+    Reports the client's share of a traced input: the time spent getting the
+    input to the server and the frame back, less the server's share, and the
+    time spent drawing the frame. Sent without an id.
+
+history_request: ['H', start, count]
+    Server <-- Client
+    Asks for count lines of scrollback, starting from line number start. A
+    negative start counts back from the newest line, so ['H', -100, 100]
+    asks for the last hundred lines.
+
+    Server should reply with a history_message.
+
 leave_request: ['l']
     Server <-- Client
     Asks to leave.
 
     Server should reply with an OkMessage and then terminate the connection.
 
-change_message: ['?', [[ change ]] ]
+change_message: ['?', [[ change ]], ([x, y]) ]
     Server --> Client
     Represents a change as transmitted to a client.
 
+    The server sends one of these for every frame of terminal output, carrying
+    all lines changed in that frame. If the cursor moved during the frame its
+    new position is included.
+
 screen_message: ['%', [[ line ]], change_number ]
     Server --> Client
     Represents an entire screen. The list of lines represents the rows of the
     screen printed from top to bottom. The change_number is the number of the
-    most recent change.
+    first change the screen does not include.
+
+history_message: ['H', first, [[ line ]], oldest, end]
+    Server --> Client
+    Lines of scrollback, oldest first, starting with line number first.
+    Scrollback lines are numbered from 0 for the first line ever to scroll
+    off the screen; oldest is the number of the oldest line the server still
+    has and end is one more than the newest.
+
+    The server may send fewer lines than were asked for.
 
 error_message: ['e', string]
     Server --> Client
@@ -114,7 +304,8 @@ settings_message: ['s', {{ ? }}]
     Server --> Client
     Sends terminal settings back to client. It should probably at least include
     fields 'cols' and 'rows', which are ints representing the terminal
-    dimensions.
+    dimensions, and 'encoding', the encoding chosen for messages to this
+    client.
 
 owner_message: ['~', int]
     Server --> Client
@@ -129,11 +320,19 @@ ok_message: ['o']
     Noop message used when a command was acknowledged but the server has
     nothing to say.
 
+trace_message: ['t', trace_id, {'write': ms, 'read': ms, 'frame': ms,
+        'send': ms}]
+    Server --> Client
+    Says when a traced input got to each stage, in milliseconds since the
+    server received it: written to the terminal, the terminal's answer read,
+    made into a frame, and the frame sent.
+
 cursor_message: ['_', x, y]
     Server --> Client
     Informs the client of the position of the cursor.
 
-    This cannot be requested.
+    This cannot be requested. Cursor movement normally arrives as part of a
+    change_message instead.
 
 chat_message: [':', sender, message]
     Server --> Client
@@ -163,9 +362,20 @@ change_number: int
     most recent change number and send a change request for the changes
     following it as soon as possible.
 
-change: [change_number, line_number, line]
+change: [change_number, line_number, line] | span_change
     Represents a change in a line.
 
+span_change: [change_number, line_number, line, column]
+    Represents a change to part of a line: the cells starting at column are
+    replaced by the cells in line, and the rest of the line stays as it was.
+
+    Live frames use these for every client of the terminal, and may hold
+    several with the same change_number for different parts of the same
+    line, so they only make sense to a client that has the line as it was
+    just before. A client must ask for a screen, or the changes since its
+    last change_number, whenever it connects, reconnects included. Replies
+    to change_requests always use whole lines.
+
 line_number: int
     Represents the number of a changed line.
 
@@ -255,14 +465,25 @@ color_spec: int
     denotes the default color scheme (56 / 0x38 / white-on-black).
 """
 
-def ChangeMessage(changes):
+def ChangeMessage(changes, cursor = None):
+    """
+    Takes changes whose lines are already encoded, and an optional (x, y)
+    cursor position.
+    """
+    if cursor:
+        return [
+            "?", list(changes), list(cursor)
+        ]
     return [
-        "?", map(represent_change, changes)
+        "?", list(changes)
     ]
 
-def ScreenMessage(change_number, screen):
+def ScreenMessage(change_number, lines):
+    """
+    Takes the encoded lines of the screen, top to bottom.
+    """
     return [
-        "%", map(represent_line, screen), change_number
+        "%", list(lines), change_number
     ]
 
 def HelloMessage():
@@ -296,16 +517,69 @@ def ChatMessage(sender, message):
 
 def OwnerMessage(owner_value):
     return ["~", owner_value]
+
+def HistoryMessage(first, lines, oldest, end):
+    return ["H", first, list(lines), oldest, end]
+
+def TraceMessage(trace_id, stamps):
+    return ["t", trace_id, stamps]
 NONE = 0
 YOU = 1
 NOT_YOU = 2
 # ---- Data ----
 
-def represent_change(change):
-    change_number, line_number, line = change
-    return [change_number, line_number, represent_line(line)]
+line_cache = OrderedDict()
+
+def represent_spans(old, new):
+    """
+    Represents a change from the cells in old to the cells in new as a list of
+    (column, line) pairs covering just the cells that differ.
+
+    Returns None if there is no old line to compare against or if resending
+    the whole line would be about as cheap.
+    """
+    if old is None or len(old) != len(new):
+        return None
+    spans = []
+    start = end = None
+    for x in xrange(len(new)):
+        if old[x] == new[x]:
+            continue
+        if start is None:
+            start = x
+        elif x - end > SPAN_GAP:
+            spans.append((start, end))
+            start = x
+        end = x + 1
+    if start is not None:
+        spans.append((start, end))
+    if sum(e - s for s, e in spans) > len(new) / 2:
+        return None
+    return [(s, encode_line(new[s:e])) for s, e in spans]
 
 def represent_line(line):
+    """
+    Represents a line, reusing the earlier representation of any line with the
+    same content.
+
+    Identical lines (blank rows, status bars, borders) share a single encoded
+    tuple. The least recently used lines are forgotten once there are more
+    than LINE_CACHE_SIZE of them.
+    """
+    key = tuple(line)
+    try:
+        out = line_cache.pop(key)
+    except KeyError:
+        out = encode_line(key)
+        if len(line_cache) >= LINE_CACHE_SIZE:
+            line_cache.popitem(last = False)
+    line_cache[key] = out
+    return out
+
+def encode_line(line):
+    """
+    Encodes a run of cells without going through the cache.
+    """
     out = []
     last_real = None
     for i in line:
@@ -318,6 +592,37 @@ def represent_line(line):
         else:
             last_real = next_
             out.append(next_)
+    return tuple(out)
+
+def compact_cells(cells):
+    """
+    Encodes a run of cells that are already encoded one by one, as
+    encode_line does for pyte's.
+    """
+    out = []
+    last_real = None
+    for i in cells:
+        if i == last_real:
+            if isinstance(out[-1], int):
+                out[-1] += 1
+            else:
+                out.append(1)
+        else:
+            last_real = i
+            out.append(i)
+    return tuple(out)
+
+def expand_line(line):
+    """
+    Undoes encode_line as far as the cells: returns a list with one encoded
+    cell for each column.
+    """
+    out = []
+    for i in line:
+        if isinstance(i, (int, long)):
+            out.extend([out[-1]] * i)
+        else:
+            out.append(tuple(i) if isinstance(i, list) else i)
     return out
 
 char_colors = {
@@ -356,14 +661,26 @@ def represent_colorof(char):
     if char.reverse         : basic |= flag_reverse
     return basic
 
+char_cache = {}
+
 def represent_char(char):
     """
     Represents a Pyte-style Char.
     """
+    try:
+        return char_cache[char]
+    except KeyError:
+        pass
+    if len(char_cache) >= CHAR_CACHE_SIZE:
+        char_cache.clear()
+    out = char_cache[char] = encode_char(char)
+    return out
+
+def encode_char(char):
     cvalue = represent_colorof(char)
     dat = (char.data.encode("utf-8") if isinstance(char.data, unicode)
         else char.data)
     if cvalue == 56: # default color
         return char.data
     else:
-        return [char.data, cvalue]
+        return (char.data, cvalue)
@@ -0,0 +1,131 @@
+"""
+Counters and latency histograms for the frame pipeline, served at /metrics in
+the Prometheus text format.
+
+Recording something is a dict lookup and an addition or two, so it is cheap
+enough to leave on all the time. Anything that already keeps its own count,
+like a client's queue, is read when /metrics is fetched instead of being
+counted as it happens.
+"""
+import time
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the buckets latencies are counted in.
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+metrics = [] # everything render() reports, in the order it was defined
+
+def format_labels(names, values, extra = ()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name,
+        str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs)
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+    kind = "untyped"
+    def __init__(self, name, help_, labels = ()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        metrics.append(self)
+    def render(self):
+        out = ["# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.kind)]
+        for values, value in sorted(self.samples()):
+            out.extend(self.render_sample(values, value))
+        return out
+    def render_sample(self, values, value):
+        return ["%s%s %s" % (self.name, format_labels(self.labels, values),
+            format_value(value))]
+
+class Counter(Metric):
+    """
+    A count that only goes up, like frames sent or bytes read.
+    """
+    kind = "counter"
+    def __init__(self, name, help_, labels = ()):
+        Metric.__init__(self, name, help_, labels)
+        self.values = {}
+    def inc(self, amount = 1, labels = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    def samples(self):
+        return self.values.items()
+
+class Histogram(Metric):
+    """
+    Counts observations, usually latencies in seconds, in buckets.
+    """
+    kind = "histogram"
+    def __init__(self, name, help_, labels = (), buckets = LATENCY_BUCKETS):
+        Metric.__init__(self, name, help_, labels)
+        self.buckets = buckets
+        self.values = {} # labels -> [count in each bucket..., sum]
+    def observe(self, value, labels = ()):
+        try:
+            counts = self.values[labels]
+        except KeyError:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+    def time(self, since, labels = ()):
+        """
+        Observes the time since since, a time.time(), and returns the time
+        now so that consecutive stages can be timed with one call each.
+        """
+        now = time.time()
+        self.observe(now - since, labels)
+        return now
+    def samples(self):
+        return self.values.items()
+    def render_sample(self, values, counts):
+        out = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            out.append("%s_bucket%s %s" % (self.name,
+                format_labels(self.labels, values,
+                    [("le", format_value(bound))]),
+                total))
+        labels = format_labels(self.labels, values)
+        out.append("%s_sum%s %s" % (self.name, labels, repr(counts[-1])))
+        out.append("%s_count%s %s" % (self.name, labels, total))
+        return out
+
+class Collected(Metric):
+    """
+    A value that is read when the metrics are fetched. collect returns a list
+    of (label values, value).
+    """
+    def __init__(self, name, help_, labels, collect, kind = "gauge"):
+        Metric.__init__(self, name, help_, labels)
+        self.collect = collect
+        self.kind = kind
+    def samples(self):
+        return self.collect()
+
+def render():
+    out = []
+    for i in metrics:
+        out.extend(i.render())
+    return "\n".join(out) + "\n"
+
+stage_seconds = Histogram("webterm_stage_seconds",
+    "Time spent in each stage of turning terminal output into messages.",
+    ("stage",))
+pty_bytes = Counter("webterm_pty_read_bytes_total",
+    "Bytes read from terminals.", ("session",))
+frames = Counter("webterm_frames_total",
+    "Frames made from terminal output.", ("session",))
+input_seconds = Histogram("webterm_input_trace_seconds",
+    "Time traced inputs spent in each stage, from the server receiving them "
+    "to the client drawing the result.", ("session", "stage"))
+messages_sent = Counter("webterm_messages_total",
+    "Messages queued for clients.", ("session",))
@@ -0,0 +1,183 @@
+"""
+Recording sessions to disk and playing them back.
+
+A recording is two files. name.rec holds a msgpack header and then one
+msgpack record per frame, each an already encoded frame:
+    ('f', seconds, [[ (line_number, line) ]], cursor | None)
+and, every RECORDING_KEYFRAME_INTERVAL seconds, a keyframe after the frame
+holding the whole screen as that frame left it:
+    ('k', seconds, [[ line ]], cursor)
+name.idx holds a fixed-size (seconds, offset) entry for every keyframe, so a
+seek reads a few index entries and one keyframe, not the whole recording.
+
+Both files are only ever appended to, and the index entry for a keyframe is
+written after the keyframe itself, so a recording can be played while it is
+still being made.
+"""
+import os
+import time
+import struct
+
+import msgpack
+import gevent
+
+from termsess import SessionStateError
+from config import RECORDING_KEYFRAME_INTERVAL
+
+INDEX_ENTRY = struct.Struct("!dQ") # seconds, offset in the .rec file
+READ_SIZE = 65536
+
+class Recorder(object):
+    """
+    Appends frames to a recording. screen is called for the (lines, cursor)
+    of the whole screen whenever a keyframe is due.
+    """
+    def __init__(self, path, rows, cols, screen):
+        self.screen = screen
+        self.started = time.time()
+        self.last_keyframe = None
+        self.file = open(path + ".rec", "wb")
+        self.index = open(path + ".idx", "wb")
+        self.file.write(msgpack.packb({
+            "version"   : 1,
+            "rows"      : rows,
+            "cols"      : cols,
+            "started"   : self.started
+        }))
+    def add_frame(self, changes, cursor):
+        """
+        Takes the frame's changes as the change table made them.
+        """
+        now = time.time() - self.started
+        self.file.write(msgpack.packb(("f", now,
+            [(line_number, line) for n, line_number, line in changes],
+            cursor)))
+        if (self.last_keyframe is None
+                or now - self.last_keyframe >= RECORDING_KEYFRAME_INTERVAL):
+            self.keyframe(now)
+        self.file.flush()
+    def keyframe(self, now):
+        """
+        Writes the screen as it is after the last frame.
+        """
+        lines, cursor = self.screen()
+        offset = self.file.tell()
+        self.file.write(msgpack.packb(("k", now, lines, cursor)))
+        self.file.flush()
+        self.index.write(INDEX_ENTRY.pack(now, offset))
+        self.index.flush()
+        self.last_keyframe = now
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+def find_keyframe(index_path, seconds):
+    """
+    Returns the (seconds, offset) of the last keyframe at or before seconds,
+    or of the first keyframe if there is none that early.
+    """
+    with open(index_path, "rb") as f:
+        entries = os.fstat(f.fileno()).st_size // INDEX_ENTRY.size
+        if not entries:
+            return None
+        def entry(i):
+            f.seek(i * INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+        low, high = 0, entries - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if entry(middle)[0] <= seconds:
+                low = middle
+            else:
+                high = middle - 1
+        return entry(low)
+
+class Playback(object):
+    """
+    Plays a recording as though it were a TerminalSession, taking the same
+    arguments with the recording's path, less its extension, as the command.
+    Input is ignored.
+    """
+    def __init__(self, cmd, args, working_dir, **params):
+        self.path = cmd
+        self.params = params
+        self.running = False
+        self.last_read = 0
+        self.speed = 1.0
+        self.anchor = (0, 0.0) # (seconds into the recording, when we were)
+
+    def start(self, framecallback):
+        if self.running:
+            raise SessionStateError("Playback already running")
+        self.running = True
+        self.callback = framecallback
+        self.seek(0)
+
+    def end(self):
+        self.running = False
+        self.reader = None
+
+    def position(self):
+        seconds, since = self.anchor
+        return seconds + (time.time() - since) * self.speed
+
+    def seek(self, seconds):
+        """
+        Jumps to seconds into the recording: loads the keyframe before it,
+        applies the frames between in one go and plays on from there.
+        """
+        keyframe = find_keyframe(self.path + ".idx", seconds)
+        if not keyframe:
+            return
+        self.anchor = (max(seconds, keyframe[0]), time.time())
+        self.reader = gevent.spawn(self.play, keyframe[1], self.anchor[0])
+
+    def set_speed(self, speed):
+        position = self.position()
+        self.speed = speed
+        self.seek(position)
+
+    def play(self, offset, target):
+        me = gevent.getcurrent()
+        lines = {} # changes not yet sent, line_number -> line
+        cursor = None
+        loaded = False # whether we have been through the first keyframe
+        with open(self.path + ".rec", "rb") as f:
+            f.seek(offset)
+            for record in msgpack.Unpacker(f, use_list = False,
+                    read_size = READ_SIZE):
+                if self.reader is not me:
+                    return
+                kind, seconds, changes, new_cursor = record
+                if kind == "k":
+                    if loaded: # the frames before it made the same screen
+                        continue
+                    loaded = True
+                    changes = enumerate(changes)
+                if seconds > target:
+                    self.send(lines, cursor)
+                    lines, cursor = {}, None
+                    since = self.anchor[1]
+                    delay = since + (seconds - target) / self.speed - time.time()
+                    if delay > 0:
+                        gevent.sleep(delay)
+                    if self.reader is not me:
+                        return
+                lines.update(changes)
+                cursor = new_cursor or cursor
+            self.send(lines, cursor)
+
+    def send(self, lines, cursor):
+        if lines or cursor:
+            self.last_read = time.time()
+            self.callback([(line_number, line, None)
+                for line_number, line in sorted(lines.iteritems())], cursor)
+
+    def ready(self):
+        return self.running
+    def keypress(self, keycode):
+        pass
+    def input_text(self, s):
+        pass
+    def input_bytes(self, b):
+        pass
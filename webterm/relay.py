@@ -0,0 +1,168 @@
+"""
+Relaying a terminal served by another webterm.
+
+A relay connects to its upstream as one client and serves the terminal to its
+own clients from its own change table, so the audience can be spread over as
+many processes and machines as it takes. A relay's upstream can itself be a
+relay. Only the origin runs the command: a relay passes its arbiter's keys on
+upstream.
+"""
+import time
+import urlparse
+
+import gevent
+
+from client import ApiClient, ClientError
+from termsess import SessionStateError
+from messages import expand_line, compact_cells, YOU
+from config import RELAY_AUTH, RELAY_RETRY
+
+class RelaySession(object):
+    """
+    Stands in for a TerminalSession whose terminal is upstream. Takes the same
+    arguments, with the upstream's url, like http://origin:5000/api, as the
+    command.
+    """
+    def __init__(self, cmd, args, working_dir, **params):
+        if not params.get("restart"): params["restart"] = False
+
+        self.url = cmd
+        self.params = params
+        self.running = False
+        self.last_read = 0
+        self.controlling = False # whether we are the upstream's arbiter
+        self.wants_control = False # whether our own arbiter wants it
+
+    def start(self, framecallback):
+        if self.running:
+            raise SessionStateError("RelaySession already running")
+
+        url = urlparse.urlparse(self.url)
+        self.upstream = ApiClient(url.hostname, url.port or 80,
+            url.path.rstrip("/") or "/api")
+        self.callback = framecallback
+        self.rows = {} # line_number -> its cells, one per column
+
+        # We are only running once the upstream has answered, so that a
+        # failed attempt leaves nothing behind to stop the next one.
+        try:
+            self.upstream.connect()
+            settings = self.wait_for(self.upstream.request("s",
+                {"encodings": ["msgpack", "json"]}))
+            self.params["rows"] = settings[1]["rows"]
+            self.params["cols"] = settings[1]["cols"]
+            if RELAY_AUTH:
+                self.upstream.notify(":", "/auth %s" % RELAY_AUTH)
+            if self.wants_control:
+                self.upstream.notify(":", "/take")
+            # Wait for the screen, so that we never serve a blank one.
+            screen = self.wait_for(self.upstream.request("%"))[1]
+        except:
+            self.upstream.close()
+            raise
+        self.running = True
+        self.apply_screen(screen)
+        self.reader = gevent.spawn(self.read_loop)
+
+    def wait_for(self, id_):
+        """
+        Returns the response to request id_, throwing away anything else that
+        arrives first.
+        """
+        while True:
+            message = self.upstream.receive()
+            if message is None:
+                raise ClientError("upstream closed")
+            if message[0] == id_:
+                return message[1]
+
+    def end(self):
+        self.running = False
+        self.reader = None
+        self.controlling = False
+        self.upstream.close()
+        if self.params["restart"]:
+            gevent.spawn_later(RELAY_RETRY, self.reconnect)
+
+    def reconnect(self):
+        try:
+            self.start(self.callback)
+        except Exception:
+            gevent.spawn_later(RELAY_RETRY, self.reconnect)
+
+    def read_loop(self):
+        """
+        Turns everything the upstream says about the screen into frames.
+        """
+        me = gevent.getcurrent()
+        while self.reader is me:
+            message = self.upstream.receive()
+            if message is None: # the upstream went away
+                if self.reader is me:
+                    self.end()
+                return
+            response = message[1]
+            tag = response[0]
+            if tag == "%":
+                self.apply_screen(response[1])
+            elif tag == "?":
+                self.apply_changes(response[1],
+                    response[2] if len(response) > 2 else None)
+            elif tag == "~":
+                self.controlling = response[1] == YOU
+
+    def apply_screen(self, lines):
+        frame = []
+        for line_number, line in enumerate(lines):
+            cells = self.rows[line_number] = expand_line(line)
+            frame.append((line_number, compact_cells(cells), None))
+        self.send(frame, None)
+
+    def apply_changes(self, changes, cursor):
+        spans = {} # line_number -> its spans, or None if it changed whole
+        for change in changes:
+            line_number, line = change[1], change[2]
+            if len(change) > 3:
+                row = self.rows.get(line_number)
+                if row is None:
+                    continue
+                column = change[3]
+                cells = expand_line(line)[:len(row) - column]
+                row[column:column + len(cells)] = cells
+                if spans.get(line_number, []) is not None:
+                    spans.setdefault(line_number, []).append(
+                        (column, compact_cells(cells)))
+            else:
+                self.rows[line_number] = expand_line(line)
+                spans[line_number] = None
+        self.send([(line_number, compact_cells(self.rows[line_number]),
+            spans[line_number]) for line_number in sorted(spans)],
+            tuple(cursor) if cursor else None)
+
+    def send(self, lines, cursor):
+        if lines or cursor:
+            self.last_read = time.time()
+            self.callback(lines, cursor)
+
+    def owner_changed(self, owner):
+        """
+        Takes control upstream while we have an arbiter, and gives it up
+        when we don't.
+        """
+        self.wants_control = owner is not None
+        if not self.running:
+            return
+        if self.wants_control and not self.controlling:
+            self.upstream.notify(":", "/take")
+        elif not self.wants_control and self.controlling:
+            self.upstream.notify(":", "/drop")
+
+    def ready(self):
+        return self.running
+    def keypress(self, keycode):
+        self.input_bytes([keycode])
+    def input_text(self, s):
+        self.input_bytes(bytearray(s))
+    def input_bytes(self, b):
+        if self.running:
+            self.upstream.notify("i", list(b))
@@ -0,0 +1,86 @@
+"""
+Keeping the lines that scroll off the top of a terminal.
+"""
+import zlib
+from collections import deque
+
+import pyte
+import msgpack
+
+from messages import represent_line
+from config import SCROLLBACK_MEMORY, SCROLLBACK_BLOCK_LINES
+
+class ScrollbackScreen(pyte.DiffScreen):
+    """
+    A DiffScreen that encodes each line scrolling off its top and keeps it in
+    scrolled until someone takes it.
+
+    Only scrolling the whole screen counts. Lines scrolling out of a region,
+    as in an editor, are not history.
+    """
+    def __init__(self, *args):
+        self.scrolled = []
+        super(ScrollbackScreen, self).__init__(*args)
+    def index(self):
+        top, bottom = self.margins
+        if self.cursor.y == bottom and top == 0 and bottom == self.lines - 1:
+            self.scrolled.append(represent_line(self[top]))
+        super(ScrollbackScreen, self).index()
+
+class Scrollback(object):
+    """
+    Encoded lines that have scrolled off the screen, numbered from 0 for the
+    first line ever to scroll off.
+
+    New lines gather in an open block. Every block_lines of them are packed
+    and compressed into a block of their own, and once the blocks add up to
+    more than memory bytes the oldest are thrown away, so what a session
+    keeps depends on the cap and not on how long it has been running.
+    """
+    def __init__(self, memory = SCROLLBACK_MEMORY,
+            block_lines = SCROLLBACK_BLOCK_LINES):
+        self.memory = memory
+        self.block_lines = block_lines
+        self.blocks = deque() # (number of its first line, line count, data)
+        self.open = []
+        self.size = 0 # bytes of compressed blocks
+        self.oldest = 0 # number of the oldest line kept
+        self.end = 0 # number after the newest line
+        self.unpacked = (None, None) # (data, lines) of the last block read
+    def extend(self, lines):
+        for i in lines:
+            self.open.append(i)
+            self.end += 1
+            if len(self.open) >= self.block_lines:
+                self.seal()
+    def seal(self):
+        data = zlib.compress(msgpack.packb(self.open))
+        self.blocks.append((self.end - len(self.open), len(self.open), data))
+        self.size += len(data)
+        self.open = []
+        while self.size > self.memory:
+            first, count, data = self.blocks.popleft()
+            self.size -= len(data)
+            self.oldest = first + count
+    def unpack(self, data):
+        if self.unpacked[0] is not data:
+            self.unpacked = (data, msgpack.unpackb(zlib.decompress(data),
+                use_list = False))
+        return self.unpacked[1]
+    def lines(self, start, count):
+        """
+        Returns the number of the first line found and up to count lines
+        from start on, leaving out any that are no longer kept.
+        """
+        start = min(max(start, self.oldest), self.end)
+        stop = min(start + count, self.end)
+        out = []
+        for first, n, data in self.blocks:
+            if first < stop and first + n > start:
+                out.extend(self.unpack(data)[max(0, start - first):
+                    stop - first])
+        open_first = self.end - len(self.open)
+        if stop > open_first:
+            out.extend(self.open[max(0, start - open_first):
+                stop - open_first])
+        return start, out
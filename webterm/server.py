@@ -0,0 +1,52 @@
+"""
+The socket.io server webterm runs under.
+
+Its sockets queue messages for their clients in a ClientQueue, so that a
+client using a compressed encoding has its messages compressed on their way
+out, in the order they are sent.
+"""
+from gevent.queue import Queue
+from socketio.server import SocketIOServer
+from socketio.virtsocket import Socket
+
+class ClientQueue(Queue):
+    """
+    A socket's queue of messages for its client. Once the socket has a
+    compressor, every message leaving the queue goes through it, so the
+    messages thrown away while they wait never get into the stream.
+
+    The transport waits on the queue from the moment the socket connects, so
+    it has to be the socket's queue from the start.
+    """
+    def __init__(self):
+        Queue.__init__(self)
+        self.compressor = None
+    def get(self, block = True, timeout = None):
+        item = Queue.get(self, block, timeout)
+        if self.compressor:
+            return self.compressor(item)
+        return item
+    def get_queued(self, block = True, timeout = None):
+        """
+        Takes the next message as it was queued, not compressed.
+        """
+        return Queue.get(self, block, timeout)
+
+class WebtermServer(SocketIOServer):
+    """
+    A SocketIOServer whose sockets queue their messages in ClientQueues.
+    """
+    def make_socket(self):
+        socket = Socket(self, self.config)
+        socket.client_queue = ClientQueue()
+        return socket
+    def get_socket(self, sessid = ''):
+        socket = self.sockets.get(sessid)
+        if sessid and not socket:
+            return None
+        if socket is None:
+            socket = self.make_socket()
+            self.sockets[socket.sessid] = socket
+        else:
+            socket.incr_hits()
+        return socket
@@ -0,0 +1,152 @@
+"""
+Keeping a terminal's screen in a memory-mapped file for other processes.
+
+The file is a fixed-size header and then a cell grid, little-endian:
+    magic 'WTSN', version, rows, cols        4 bytes each
+    sequence                                 8 bytes
+    cursor x, cursor y                       4 bytes each
+    rows * cols cells, row by row, each      (code point, color) 4 bytes each
+color being represent_colorof's value for the cell.
+
+The writer makes the sequence odd before it changes anything and even again
+once it is done, so a reader that sees the same even sequence before and
+after reading has a consistent screen. Readers never ask the server for
+anything, and can read single cells or rows straight out of the mapping.
+"""
+import os
+import sys
+import mmap
+import struct
+
+from messages import expand_line
+
+MAGIC = "WTSN"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIQII")
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 16
+CELL = struct.Struct("<II")
+DEFAULT_COLOR = 56 # white on black, left out of encoded cells
+ROW_CACHE_SIZE = 1024 # distinct packed rows to remember
+
+def cell_values(cell):
+    """
+    Returns the (code point, color) of an encoded cell.
+    """
+    if isinstance(cell, tuple):
+        data, color = cell
+    else:
+        data, color = cell, DEFAULT_COLOR
+    if isinstance(data, str):
+        data = data.decode("utf-8", "replace")
+    return (ord(data[0]) if data else 0), color
+
+class Snapshot(object):
+    """
+    Writes a terminal's screen to path as frames arrive. Only the terminal's
+    reader writes it, like the change table.
+    """
+    def __init__(self, path, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.row_size = cols * CELL.size
+        self.sequence = 0
+        self.packed = {} # encoded line -> its row of cells, packed
+        size = HEADER.size + rows * self.row_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, rows, cols,
+            self.sequence, 0, 0)
+    def pack_row(self, line):
+        try:
+            return self.packed[line]
+        except KeyError:
+            pass
+        if len(self.packed) >= ROW_CACHE_SIZE:
+            self.packed.clear()
+        cells = [cell_values(i) for i in expand_line(line)[:self.cols]]
+        cells.extend([(ord(" "), DEFAULT_COLOR)] * (self.cols - len(cells)))
+        out = self.packed[line] = struct.pack("<%dI" % (2 * self.cols),
+            *[value for cell in cells for value in cell])
+        return out
+    def add_frame(self, changes, cursor):
+        """
+        Takes the frame's changes as the change table made them.
+        """
+        self.set_sequence(self.sequence + 1)
+        for n, line_number, line in changes:
+            if line_number < self.rows:
+                offset = HEADER.size + line_number * self.row_size
+                self.map[offset:offset + self.row_size] = self.pack_row(line)
+        if cursor:
+            struct.pack_into("<II", self.map, SEQUENCE_OFFSET + SEQUENCE.size,
+                cursor[0], cursor[1])
+        self.set_sequence(self.sequence + 1)
+    def set_sequence(self, sequence):
+        self.sequence = sequence
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, sequence)
+    def close(self):
+        self.map.close()
+
+class SnapshotReader(object):
+    """
+    Maps a snapshot written by another process, read-only.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, self.rows, self.cols = HEADER.unpack_from(
+            self.map)[:4]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a screen snapshot" % path)
+        self.row_size = self.cols * CELL.size
+    def sequence(self):
+        return SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0]
+    def cursor(self):
+        return struct.unpack_from("<II", self.map,
+            SEQUENCE_OFFSET + SEQUENCE.size)
+    def cell(self, x, y):
+        """
+        Returns the (code point, color) of the cell at x, y.
+        """
+        return CELL.unpack_from(self.map,
+            HEADER.size + y * self.row_size + x * CELL.size)
+    def row(self, y):
+        """
+        Returns row y's packed cells as a buffer over the mapping, without
+        copying them.
+        """
+        return buffer(self.map, HEADER.size + y * self.row_size,
+            self.row_size)
+    def read(self, reader):
+        """
+        Calls reader(self) until it has read the screen with no frame being
+        written meanwhile, and returns what it returned.
+        """
+        while True:
+            before = self.sequence()
+            if before % 2:
+                continue
+            out = reader(self)
+            if self.sequence() == before:
+                return out
+    def text(self):
+        """
+        Returns a consistent copy of the screen as lines of text.
+        """
+        row = struct.Struct("<%dI" % (2 * self.cols))
+        def lines(snapshot):
+            return [u"".join(unichr(i) for i in row.unpack_from(snapshot.map,
+                HEADER.size + y * snapshot.row_size)[::2] if i)
+                for y in range(snapshot.rows)]
+        return self.read(lines)
+    def close(self):
+        self.map.close()
+
+if __name__ == "__main__":
+    for line in SnapshotReader(sys.argv[1]).text():
+        print line.rstrip().encode("utf-8")
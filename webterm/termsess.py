@@ -1,53 +1,114 @@
 import pyte
 import pty, os, subprocess
 import termios
-import select
-import time
+import errno
 import fcntl
 import struct
-from cStringIO import StringIO
+import time
+import traceback
 import os.path
+
+import gevent
+from gevent.socket import wait_read, wait_write
+from gevent.event import Event
+
+from messages import represent_line, represent_spans
+from scrollback import ScrollbackScreen, Scrollback
+import metrics
+from config import QUICK_EXIT, RESTART_DELAY, RESTART_MAX_DELAY
+
+READ_SIZE = 65536 # most we will take from the child in one read
+
 class SessionStateError(Exception): pass
 
+class FrameScheduler(object):
+    """
+    Decides how long output may pile up before it goes out as a frame.
+
+    A frame answering a keypress goes out straight away, so echo is never held
+    back. Otherwise frames are kept to at most max_fps a second, which only
+    matters while the child is flooding us with output.
+    """
+    def __init__(self, max_fps):
+        self.interval = 1.0 / max_fps if max_fps else 0.0
+        self.last_frame = 0
+        self.last_input = 0
+        self.input = Event() # set by input, to cut a wait short
+    def note_input(self):
+        self.last_input = time.time()
+        self.input.set()
+    def note_frame(self):
+        self.last_frame = time.time()
+    def delay(self):
+        if self.last_input >= self.last_frame:
+            return 0
+        return self.last_frame + self.interval - time.time()
+    def wait(self):
+        """
+        Waits until it is time for the next frame, or until input arrives.
+        """
+        delay = self.delay()
+        if delay > 0:
+            self.input.clear()
+            self.input.wait(timeout = delay)
+
 class TerminalSession(object):
     def __init__(self, cmd, args, working_dir, **params):
         if not params.get("rows"): params["rows"] = 25
         if not params.get("cols"): params["cols"] = 80
         if not params.get("restart"): params["restart"] = False
+        if not params.get("max_fps"): params["max_fps"] = 0 # no limit
+        if not params.get("name"): params["name"] = cmd # for metrics
 
         self.cmd = cmd
         self.args = [cmd] + args
         self.working_dir = working_dir
         self.params = params
         self.running = False
+        self.last_read = 0 # when output was last read from the child
+        self.started = 0
+        self.restart_delay = 0 # grows while the command keeps exiting at once
+        self.scrollback = Scrollback()
 
         self.actual_dir = os.getcwd()
         self.home_dir = os.path.join(self.actual_dir, "home")
 
-    def start(self, evtcallback, cursorcallback):
+    def start(self, framecallback):
         """
         Launches the TerminalSession's process and adds to it the given
-        callback to deal with modified lines.
+        callback to deal with frames.
+
+        The callback takes the form callback(lines, cursor). lines is a list
+        of (line_number, line, spans) sorted by line number, where line is the
+        encoded line and spans is what represent_spans made of the change, or
+        None. cursor is an (x, y) pair, or None if the cursor has not moved
+        since the last frame.
 
-        The callback takes the form callback(line_number, line).
+        The first frame, sent straight away, covers the whole screen.
         """
         if self.running:
             raise SessionStateError("TerminalSession already running")
 
         self.running = True
-
-        self.stream = pyte.ByteStream()
-        self.screen = pyte.DiffScreen(self.params["cols"], self.params["rows"])
-        # self.screen.set_mode(pyte.modes.LNM) # This treats \ns as \r\ns.
-            # Is this necessary/reasonable?
-        self.stream.attach(self.screen)
+        self.started = time.time()
+        self.open_screen(framecallback)
 
         child_pid, self.child_fd = pty.fork()
                        
-        os.chdir(self.working_dir)
-        os.environ['HOME'] = self.home_dir
         if not child_pid: # under what circumstances would it not be 0?
-            os.execv(self.cmd, self.args)
+            # Only the child moves: other sessions in this process rely on
+            # the server's own directory and environment. The child shares
+            # the server's sockets, so if it can't run the command it must
+            # never return into the server: it says why on the terminal and
+            # exits.
+            try:
+                os.chdir(self.working_dir)
+                os.environ['HOME'] = self.home_dir
+                os.execv(self.cmd, self.args)
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(1)
 
         attr = termios.tcgetattr(self.child_fd)
         attr[3] = attr[3] & ~termios.ECHO # Disable echoing
@@ -57,66 +118,171 @@ class TerminalSession(object):
             0, 0)
         fcntl.ioctl(self.child_fd, termios.TIOCSWINSZ, winsize) # set size
 
+        # Reads happen from the reader greenlet when the hub says the fd is
+        # ready, so they must never block the whole process.
+        flags = fcntl.fcntl(self.child_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.child_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self.compose_frame()
+        self.reader = gevent.spawn(self.read_loop)
+
+    def open_screen(self, framecallback):
+        """
+        Sets up a blank screen that sends frames to framecallback. start()
+        does this before it forks; anything else can then feed() the screen
+        without a child at all.
+        """
+        self.stream = pyte.ByteStream()
+        self.screen = ScrollbackScreen(self.params["cols"],
+            self.params["rows"])
+        # self.screen.set_mode(pyte.modes.LNM) # This treats \ns as \r\ns.
+            # Is this necessary/reasonable?
+        self.stream.attach(self.screen)
 
-        self.callback = evtcallback
-        self.cursor_callback = cursorcallback
+        self.callback = framecallback
+        self.last_cursor = None
+        self.scheduler = FrameScheduler(self.params["max_fps"])
+        self.rows = {} # line_number -> cells as of the last frame
 
 
     def end(self):
         self.running = False
-        if self.params["restart"]:
-            self.start(self.callback, self.cursor_callback)
+        self.reader = None
+        try:
+            os.close(self.child_fd)
+        except OSError:
+            pass
+        if not self.params["restart"]:
+            return
+        # A command that can't even start would otherwise be forked again
+        # and again as fast as it fails.
+        ran = time.time() - self.started
+        if ran >= QUICK_EXIT:
+            self.restart_delay = 0
+            self.start(self.callback)
+            return
+        self.restart_delay = min(RESTART_MAX_DELAY,
+            self.restart_delay * 2 or RESTART_DELAY)
+        self.feed("\r\n[%s exited after %.1fs; restarting in %ds]\r\n"
+            % (self.cmd, ran, self.restart_delay))
+        gevent.spawn_later(self.restart_delay, self.restart)
+
+    def restart(self):
+        if not self.running:
+            self.start(self.callback)
+
+    def read_loop(self):
+        """
+        Waits on the child's fd and processes output as soon as there is some.
+
+        Runs in its own greenlet. A restart spawns a new reader, so each loop
+        only lives as long as it is the session's current reader.
+
+        Nothing runs until the child writes something. When the scheduler
+        says it's too soon for another frame, output is left to pile up in
+        the pty and goes out together, unless input cuts the wait short.
+        """
+        me = gevent.getcurrent()
+        while self.running and self.reader is me:
+            try:
+                wait_read(self.child_fd)
+            except Exception: # the fd went away underneath us
+                if self.reader is me:
+                    self.end()
+                return
+            self.scheduler.wait()
+            if self.reader is me:
+                self.process()
 
     def process(self):
+        """
+        Reads one chunk of whatever the child has written and feeds it to the
+        screen. Never blocks: if nothing is waiting, nothing happens.
+        """
         if not self.running:
             raise SessionStateError("TerminalSession closed or never opened")
 
-        was_at_some_time_ready = False
-
-        output = StringIO()
+        started = time.time()
         try:
-            while select.select([self.child_fd], [], [], 0.0)[0]:
-                was_at_some_time_ready = True
-                s = os.read(self.child_fd, 1)
-                if len(s) == 0: # EOF
-                    self.end()
-                    break
+            s = os.read(self.child_fd, READ_SIZE)
+            self.last_read = metrics.stage_seconds.time(started,
+                ("pty_read",))
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            s = "" # EIO is how a pty reports that the child went away
+        if not s: # EOF
+            self.end()
+            return
 
-                output.write(s)
-        except OSError: # this occasionally means EOF
-            pass
+        metrics.pty_bytes.inc(len(s), (self.params["name"],))
+        self.feed(s)
 
+    def feed(self, data):
+        """
+        Feeds terminal output to the screen and reports what it changed as a
+        single frame.
+        """
+        started = time.time()
+        self.stream.feed(data)
+        metrics.stage_seconds.time(started, ("feed",))
+        self.compose_frame()
 
-        if was_at_some_time_ready:
-            g = output.getvalue()
-            self.stream.feed(g)
-            if len(g) == 0: self.end() # EOF.
-        
-            while self.screen.dirty:
-                line_number = self.screen.dirty.pop()
-                self.callback(line_number, self.screen[line_number])
+    def compose_frame(self):
+        """
+        Collects the dirty lines and the cursor movement since the last frame,
+        encodes them and hands them to the callback in one go. Does nothing if
+        nothing changed.
+        """
+        started = time.time()
+        lines = []
+        for i in sorted(self.screen.dirty):
+            cells = tuple(self.screen[i])
+            old = self.rows.get(i)
+            if cells == old:
+                continue
+            self.rows[i] = cells
+            lines.append((i, represent_line(cells),
+                represent_spans(old, cells)))
+        self.screen.dirty.clear()
+        if self.screen.scrolled:
+            self.scrollback.extend(self.screen.scrolled)
+            self.screen.scrolled = []
 
-            self.cursor_callback(self.screen.cursor)
+        cursor = (self.screen.cursor.x, self.screen.cursor.y)
+        if self.last_cursor != cursor:
+            self.last_cursor = cursor
         else:
-            time.sleep(0.01) # wait a sec to avoid wasting CPU
-            # TODO: used this in the threaded version, is it necessary in the
-            # non-threaded one?
-            pass
+            cursor = None
+
+        metrics.stage_seconds.time(started, ("encode",))
+        if lines or cursor:
+            self.scheduler.note_frame()
+            self.callback(lines, cursor)
 
     def ready(self):
         return self.running
     def keypress(self, keycode):
         return self.input_text(chr(keycode))
     def input_text(self, s):
+        if not self.running:
+            return # waiting to restart
+        self.scheduler.note_input()
         remaining = s
         while remaining:
-           amt = os.write(self.child_fd, remaining)
-           if amt == 0:
-               self.end()
-               return
-           remaining = remaining[amt:]
+            try:
+                amt = os.write(self.child_fd, remaining)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                wait_write(self.child_fd) # the child isn't keeping up
+                continue
+            if amt == 0:
+                self.end()
+                return
+            remaining = remaining[amt:]
     def input_bytes(self, b):
-        self.input_text("".join(map(chr, b)))
+        self.input_text(str(bytearray(b)))
 if __name__ == "__main__":
     import pdb
     from messages import ChangeMessage
@@ -129,17 +295,18 @@ if __name__ == "__main__":
     def hexify(s):
         return " ".join(map(lambda i: "{0:02x}".format(ord(i)), s))
 
-    def handle_line(line_no, line):
+    def handle_frame(lines, cursor):
         global change_num
 
-        rep = ChangeMessage(change_num, line_no, line)
-        change_num += 1
-        print "{0:02}: {1}".format(len(rep), hexify(rep)[:123])
+        for line_no, line, spans in lines:
+            rep = ChangeMessage([(change_num, line_no, line)])
+            change_num += 1
+            print "{0:02}: {1}".format(len(rep), hexify(rep)[:123])
         """
         print "{0:02}  {1}".format(
             line_no, "".join(map(lambda i: i.data, line)))
         print "    {0}".format("".join(map(lambda i:i.fg[0], line)))
         """
-    g.start(handle_line)
+    g.start(handle_frame)
     while g.ready():
-        g.process()
+        g.reader.join()
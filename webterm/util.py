@@ -1,4 +1,6 @@
 import threading
+import time
+from collections import deque
 from functools import wraps
 def Category():
     return threading.RLock()
@@ -11,3 +13,19 @@ def synchronized(lock = None):
                 return f(*args, **kwargs)
         return _f
     return _dec
+
+class RateMeter(object):
+    """
+    Measures how often something happens, averaged over the last few seconds.
+    """
+    def __init__(self, window = 5.0, limit = 1024):
+        self.window = window
+        self.times = deque(maxlen = limit)
+    def tick(self):
+        self.times.append(time.time())
+    def rate(self):
+        since = time.time() - self.window
+        recent = [i for i in self.times if i >= since]
+        if len(recent) == self.times.maxlen: # more than we can remember
+            return len(recent) / (time.time() - recent[0])
+        return len(recent) / self.window
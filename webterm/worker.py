@@ -0,0 +1,137 @@
+"""
+Runs a TerminalSession in a process of its own.
+
+The worker owns the pty and the screen and does all the parsing and encoding.
+It reads keys on stdin and writes each frame to stdout as msgpack
+[lines, cursor, scrolled], scrolled being the lines that scrolled off the
+screen since the last frame, so the web process only has to pass bytes along
+and keep the scrollback.
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+
+import msgpack
+import gevent
+from gevent.os import make_nonblocking, nb_read, nb_write
+
+from termsess import READ_SIZE, SessionStateError
+from scrollback import Scrollback
+
+WORKER_SCRIPT = os.path.abspath(__file__).replace(".pyc", ".py")
+
+class WorkerSession(object):
+    """
+    Stands in for a TerminalSession whose pty lives in a worker process.
+    Takes the same arguments and offers the same methods.
+    """
+    def __init__(self, cmd, args, working_dir, **params):
+        if not params.get("restart"): params["restart"] = False
+
+        self.cmd = cmd
+        self.args = args
+        self.working_dir = working_dir
+        self.params = params
+        self.running = False
+        self.last_read = 0 # when a frame last arrived from the worker
+        self.scrollback = Scrollback()
+
+    def start(self, framecallback):
+        if self.running:
+            raise SessionStateError("WorkerSession already running")
+
+        self.running = True
+        self.callback = framecallback
+
+        self.worker = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT, json.dumps({
+                "cmd"           : self.cmd,
+                "args"          : self.args,
+                "working_dir"   : self.working_dir,
+                "params"        : self.params
+            })],
+            stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+            close_fds = True)
+        self.input_fd = self.worker.stdin.fileno()
+        self.output_fd = self.worker.stdout.fileno()
+        make_nonblocking(self.input_fd)
+        make_nonblocking(self.output_fd)
+
+        self.reader = gevent.spawn(self.read_loop)
+
+    def end(self):
+        self.running = False
+        self.reader = None
+        try:
+            self.worker.kill()
+        except OSError:
+            pass
+        self.worker.wait()
+        if self.params["restart"]:
+            self.start(self.callback)
+
+    def read_loop(self):
+        """
+        Hands every frame the worker sends on to the callback.
+        """
+        me = gevent.getcurrent()
+        unpacker = msgpack.Unpacker(use_list = False)
+        while self.running and self.reader is me:
+            try:
+                s = nb_read(self.output_fd, READ_SIZE)
+            except OSError:
+                s = ""
+            if not s: # the worker died
+                if self.reader is me:
+                    self.end()
+                return
+            self.last_read = time.time()
+            unpacker.feed(s)
+            for lines, cursor, scrolled in unpacker:
+                self.scrollback.extend(scrolled)
+                self.callback(lines, cursor)
+
+    def ready(self):
+        return self.running
+    def keypress(self, keycode):
+        return self.input_text(chr(keycode))
+    def input_text(self, s):
+        remaining = s
+        while remaining:
+            amt = nb_write(self.input_fd, remaining)
+            remaining = remaining[amt:]
+    def input_bytes(self, b):
+        self.input_text(str(bytearray(b)))
+
+def serve(cmd, args, working_dir, params):
+    """
+    The worker's side: runs the session, writes frames to stdout and types
+    whatever arrives on stdin.
+    """
+    from termsess import TerminalSession
+
+    make_nonblocking(0)
+    make_nonblocking(1)
+
+    def send_frame(lines, cursor):
+        out = msgpack.packb((lines, cursor, scrolled))
+        del scrolled[:]
+        while out:
+            out = out[nb_write(1, out):]
+
+    session = TerminalSession(cmd, args, working_dir, **params)
+    # The web process keeps the scrollback; we only pass it along.
+    session.scrollback = scrolled = []
+    session.start(send_frame)
+    while True:
+        s = nb_read(0, READ_SIZE)
+        if not s: # the web process went away, so should we
+            break
+        session.input_text(s)
+
+if __name__ == "__main__":
+    spec = json.loads(sys.argv[1])
+    serve(spec["cmd"], spec["args"], spec["working_dir"],
+        dict((str(k), v) for k, v in spec["params"].iteritems()))